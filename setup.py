@@ -18,9 +18,15 @@ setup(name='graccreq',
       'toml',
       'urllib3'
       ],
+      extras_require={
+            'zstd': ['zstandard'],
+            'msgpack': ['msgpack'],
+            'arrow': ['pyarrow>=14']
+      },
       entry_points= {
             'console_scripts': [
-                  'graccreq = graccreq.OverMind:main'
+                  'graccreq = graccreq.OverMind:main',
+                  'graccreq-replay = graccreq.replay:main'
             ]
       }
 )
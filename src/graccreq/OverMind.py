@@ -3,13 +3,82 @@ import multiprocessing
 import json
 import pika
 import sys
-from .raw_replayer import RawReplayerFactory
+import functools
+import collections
+from .raw_replayer import RawReplayerFactory, planRawPartitions
 from .summary_replayer import SummaryReplayerFactory
 from .transfer_summary import TransferSummaryFactory
+from .summaries import summaryDefinitions
+from . import reference
+from .partition import splitSummaryRange, splitRawRange
+from .checkpoint import CheckpointStore, checkpointKey
 import toml
 import argparse
 import logging
 import time
+import datetime
+import dateutil.parser
+
+
+class ReplayRequest(object):
+    """
+    Bookkeeping for a request while its partitions are replayed.
+    """
+    def __init__(self, msg, delivery_tag):
+        """
+        :param dict msg: The parsed request message
+        :param int delivery_tag: Delivery tag of the request message
+        """
+        self.msg = msg
+        self.delivery_tag = delivery_tag
+        self.pending = 0
+        self.partitions = []
+        self.errors = []
+        self.confirmed = 0
+
+
+class Partition(object):
+    """
+    A partition waiting for, or running in, the worker pool.  Identical
+    partitions of several requests are replayed once, and published to the
+    destination of every request.
+    """
+
+    # Fields of a message that do not change what is replayed
+    routing_fields = ('destination', 'routing_key', 'control', 'control_key')
+
+    def __init__(self, factory, msg):
+        """
+        :param function factory: One of the ``*Factory`` functions
+        :param dict msg: The message of the partition
+        """
+        self.factory = factory
+        self.msg = msg
+        self.requests = []
+        self.destinations = []
+
+    @classmethod
+    def key(cls, factory, msg):
+        """
+        Key that is equal for partitions that replay the same records.
+        """
+        fields = {k: v for k, v in msg.items() if k not in cls.routing_fields}
+        if msg.get('credit'):
+            # Flow control is between one replayer and one client
+            fields = msg
+        return (factory.__name__, json.dumps(fields, sort_keys=True, default=str))
+
+    def addRequest(self, request):
+        """
+        Add a request that waits for this partition.
+
+        :param ReplayRequest request: The request
+        """
+        self.requests.append(request)
+        destination = [request.msg['destination'], request.msg['routing_key']]
+        if destination not in self.destinations:
+            self.destinations.append(destination)
+
 
 class OverMind:
     """
@@ -19,13 +88,37 @@ class OverMind:
     def __init__(self, configuration):
         
         self._pool = None
-        self._running_jobs = []
+        
+        # Partitions waiting for a free worker, by their key, and the
+        # number of partitions running in the pool
+        self._pending = collections.OrderedDict()
+        self._running = 0
+        # Keys of the partitions running in the pool, and partitions
+        # waiting for an identical running one to fill the summary cache
+        self._running_keys = collections.Counter()
+        self._followers = {}
         
         # Import the configuration
         self._config = {}
         with open(configuration, 'r') as config_file:
             self._config = toml.loads(config_file.read())
         
+        # Number of worker processes, and whether requests are only acked
+        # once the job has finished (rather than when it is dispatched)
+        self._processes = self._config.get('General', {}).get('processes', 4)
+        self._ack_on_completion = self._config['AMQP'].get('ack_on_completion', False)
+        
+        # Requests are split into partitions of this many days, and
+        # raw partitions with more records than partition_max_docs are
+        # split further
+        self._partition_days = self._config.get('General', {}).get('partition_days', 1)
+        self._partition_max_docs = self._config.get('General', {}).get('partition_max_docs', 0)
+        # Checkpoints of finished partitions are kept until their whole request has finished
+        checkpoint_dir = self._config.get('General', {}).get('checkpoint_dir')
+        self._checkpoints = CheckpointStore(checkpoint_dir) if checkpoint_dir else None
+        # Kinds of summaries, checked when the daemon starts
+        self._summaries = summaryDefinitions(self._config)
+        
         logging.basicConfig(level=logging.DEBUG)
         logging.getLogger("pika").setLevel(logging.WARNING)
         multiprocessing.log_to_stderr()
@@ -37,10 +130,15 @@ class OverMind:
         """
         
         # Start up the pool processes
-        self._pool = multiprocessing.Pool(processes=4)
+        self._pool = multiprocessing.Pool(processes=self._processes, initializer=reference.warm,
+                                          initargs=(self._config,))
         self.createConnection()
+        if self._ack_on_completion:
+            # Only take as many requests from the broker as we have workers.
+            # The rest stay on the queue, where other OverMinds can take them
+            # and where they survive a crash of this daemon.
+            self._chan.basic_qos(prefetch_count=self._processes)
         self._chan.basic_consume(queue=self._config["AMQP"]['queue'], on_message_callback=self._receiveMsg)
-        self._conn.call_later(10, self.timerEnd)
         
         # The library gives us an event loop built-in, so lets use it!
         # This program only responds to messages on the rabbitmq, so no
@@ -52,16 +150,220 @@ class OverMind:
         
         sys.exit(1)
         
-    def timerEnd(self):
-        for job in self._running_jobs:
-            if job.ready():
-                try:
-                    job.get()
-                    self._running_jobs.remove(job)
-                except Exception as e:
-                    logging.exception("Got exception from job")
-                    raise
-        self._conn.call_later(10, self.timerEnd)
+    def _callInPool(self, func, args, on_done):
+        """
+        Run ``func`` in the worker pool without waiting for it.
+
+        Completion is reported by the pool's result handler thread, which
+        schedules ``on_done(result, error)`` back onto the connection's thread.
+
+        :param function func: Function to run in a worker
+        :param tuple args: Arguments of ``func``
+        :param function on_done: Called with the result, and the exception raised or None
+        """
+        def on_success(result):
+            self._conn.add_callback_threadsafe(functools.partial(on_done, result, None))
+
+        def on_error(error):
+            self._conn.add_callback_threadsafe(functools.partial(on_done, None, error))
+
+        self._pool.apply_async(func, args, callback=on_success, error_callback=on_error)
+
+    def _startRequest(self, request, factory, partitions):
+        """
+        Send the starting control message and queue every partition of a request.
+
+        A partition that is identical to one still waiting for a worker is
+        not queued again, the waiting one will publish to this request's
+        destination as well.  A partition identical to one already running
+        waits for it to finish if it can then be read from the summary
+        cache, and is queued right away otherwise.
+
+        :param ReplayRequest request: The request
+        :param function factory: One of the ``*Factory`` functions
+        :param list partitions: Messages for each partition of the request
+        """
+        self._sendControlMessage(request.msg, {'status': 'ok', 'stage': 'starting'})
+        request.partitions = partitions
+        request.pending = len(partitions)
+        logging.debug("Queueing %s request in %i partitions" % (request.msg['kind'], len(partitions)))
+        if not partitions:
+            self._finishRequest(request)
+        for msg in partitions:
+            key = Partition.key(factory, msg)
+            if key in self._pending:
+                logging.debug("Coalescing %s partition from %s to %s" % (msg['kind'], msg['from'], msg['to']))
+                self._pending[key].addRequest(request)
+            elif key in self._running_keys and self._cacheServes(msg):
+                logging.debug("Holding %s partition from %s to %s until the running one has filled the cache"
+                              % (msg['kind'], msg['from'], msg['to']))
+                self._followers.setdefault(key, Partition(factory, msg)).addRequest(request)
+            else:
+                self._pending[key] = Partition(factory, msg)
+                self._pending[key].addRequest(request)
+        self._dispatchPending()
+
+    def _cacheServes(self, msg):
+        """
+        Whether a summary partition is read from the summary cache once an
+        identical partition has been replayed.
+
+        :param dict msg: The message of the partition
+        """
+        definition = self._summaries.get(msg['kind'])
+        if not definition or not self._config.get('General', {}).get('summary_cache_dir'):
+            return False
+        if definition.date_field != definition.time_field:
+            return False
+        if msg.get('job_id') and self._checkpoints:
+            # Replays saving checkpoints do not use the cache
+            return False
+        # Only days which are over are cached
+        last_day = dateutil.parser.parse(msg['to']).date()
+        return last_day < datetime.datetime.utcnow().date()
+
+    def _dispatchPending(self):
+        """
+        Hand waiting partitions to the worker pool while it has free workers.
+        """
+        while self._pending and self._running < self._processes:
+            key, partition = self._pending.popitem(last=False)
+            msg = dict(partition.msg, destinations=partition.destinations)
+            self._running += 1
+            self._running_keys[key] += 1
+            self._callInPool(partition.factory, (msg, self._config['AMQP']['url'], self._config),
+                             functools.partial(self._jobFinished, key, partition))
+
+    def _jobFinished(self, key, partition, result, error):
+        """
+        Called in the connection's thread when a partition has been replayed.
+
+        :param tuple key: Key of the partition
+        :param Partition partition: The partition
+        :param dict result: Status returned by the ``*Factory`` function
+        :param Exception error: The exception raised by the job, or None
+        """
+        msg = partition.msg
+        self._running -= 1
+        self._running_keys[key] -= 1
+        if not self._running_keys[key]:
+            del self._running_keys[key]
+        if key in self._followers:
+            # Identical partitions that arrived meanwhile go first
+            self._pending[key] = self._followers.pop(key)
+            self._pending.move_to_end(key, last=False)
+        if error is not None:
+            logging.error("Got exception from %s job: %s" % (msg['kind'], str(error)))
+            message = str(error)
+        elif result['status'] != 'ok':
+            message = result.get('message', '')
+        else:
+            logging.debug("Finished %s job from %s to %s" % (msg['kind'], msg['from'], msg['to']))
+            message = None
+
+        for request in partition.requests:
+            if message is not None:
+                request.errors.append(message)
+            else:
+                destination = (request.msg['destination'], request.msg['routing_key'])
+                request.confirmed += result.get('confirmed', {}).get(destination, 0)
+            request.pending -= 1
+            if request.pending == 0:
+                self._finishRequest(request)
+
+        self._dispatchPending()
+
+    def _finishRequest(self, request):
+        """
+        Send the finished control message once all partitions of a request are done.
+
+        :param ReplayRequest request: The request
+        """
+        if request.errors:
+            self._sendControlMessage(request.msg, {'status': 'error', 'stage': 'finished',
+                                                   'message': request.errors[0]})
+        else:
+            if request.msg.get('job_id') and self._checkpoints:
+                # Every partition finished, running the job again replays it all
+                for msg in request.partitions:
+                    self._checkpoints.remove(checkpointKey(msg))
+            finished = {'status': 'ok', 'stage': 'finished'}
+            if request.msg.get('confirm'):
+                finished['confirmed'] = request.confirmed
+            self._sendControlMessage(request.msg, finished)
+
+        # Failed requests are acked as well, a request that crashes the
+        # replayer would otherwise be redelivered forever
+        if self._ack_on_completion:
+            self._chan.basic_ack(delivery_tag=request.delivery_tag)
+
+    def _sendControlMessage(self, msg, control_msg):
+        """
+        Send a control message to the control exchange of a request, if it asked for one.
+
+        :param dict msg: The request message
+        :param dict control_msg: Dict message to send to the control exchange.
+        """
+        if not msg.get('control'):
+            return
+        try:
+            self._chan.basic_publish(msg['control'], msg['control_key'], json.dumps(control_msg),
+                                     pika.BasicProperties(content_type='text/json',
+                                                          delivery_mode=1))
+        except Exception as e:
+            logging.error("Exception caught in sending to control channel %s: %s" % (msg['control'], str(e)))
+
+    def _partitionSummary(self, request, factory):
+        """
+        Split a summary request into partitions of whole days, and dispatch them.
+
+        Summaries grouped by another field than the one selecting their
+        records, like transfers grouped by StartTime, are not split.  A day's
+        row would otherwise be summed from records of several partitions,
+        and published once by each of them.
+        """
+        msg = request.msg
+        definition = self._summaries[msg['kind']]
+        partitions = []
+        if self._partition_days and definition.date_field == definition.time_field:
+            for first_day, last_day in splitSummaryRange(msg['from'], msg['to'], self._partition_days):
+                partitions.append(dict(msg, _partition=True, **{'from': first_day.isoformat(),
+                                                                 'to': last_day.isoformat()}))
+        else:
+            partitions.append(dict(msg, _partition=True))
+        self._startRequest(request, factory, partitions)
+
+    def _partitionRaw(self, request):
+        """
+        Split a raw request at midnight, and dispatch the partitions.  If
+        ``partition_max_docs`` is set, a worker first counts the records
+        of each day and splits the busy days further.  Requests with a
+        ``job_id`` are only split into days: their checkpoints are kept by
+        partition, and counts that change between runs would give partitions
+        that match none of them.
+        """
+        msg = request.msg
+        if not self._partition_days:
+            self._startRequest(request, RawReplayerFactory, [dict(msg, _partition=True)])
+            return
+
+        def dispatch(windows, error):
+            if error is not None:
+                logging.error("Unable to plan raw partitions, replaying whole days: %s" % str(error))
+                windows = days
+            partitions = []
+            for start, end in windows:
+                partitions.append(dict(msg, _partition=True, to_exclusive=True,
+                                       **{'from': start.isoformat(), 'to': end.isoformat()}))
+            # The end of the request itself is included
+            partitions[-1]['to_exclusive'] = False
+            self._startRequest(request, RawReplayerFactory, partitions)
+
+        days = splitRawRange(msg['from'], msg['to'], self._partition_days)
+        if self._partition_max_docs and not msg.get('job_id'):
+            self._callInPool(planRawPartitions, (days, self._config, self._partition_max_docs), dispatch)
+        else:
+            dispatch(days, None)
 
 
     def createConnection(self):
@@ -93,29 +395,39 @@ class OverMind:
         logging.debug("Incoming Message:")
         logging.debug(str(msg_body))
         # TODO: some sort of whitelist, authentication?
-        if msg_body['kind'] == 'raw':
-            logging.debug("Received raw message, dispatching")
-            self._pool.apply_async(RawReplayerFactory, (msg_body, self.parameters, self._config))
-            
-        elif msg_body['kind'] == 'summary':
-            logging.debug("Received summary message, dispatching")
-            result = self._pool.apply_async(SummaryReplayerFactory, (msg_body, self._config['AMQP']['url'], self._config))
-            try:
-                result.get(1)
-            except multiprocessing.TimeoutError as te:
-                self._running_jobs.append(result)
-                pass
+        request = ReplayRequest(msg_body, method_frame.delivery_tag)
+        try:
+            if msg_body['kind'] == 'raw':
+                logging.debug("Received raw message, dispatching")
+                self._partitionRaw(request)
+                
+            elif msg_body['kind'] == 'summary':
+                logging.debug("Received summary message, dispatching")
+                self._partitionSummary(request, SummaryReplayerFactory)
+                
+            elif msg_body['kind'] == 'transfer_summary':
+                logging.debug("Received transfer_summary message, dispatching")
+                self._partitionSummary(request, TransferSummaryFactory)
+
+            elif msg_body['kind'] in self._summaries:
+                logging.debug("Received %s message, dispatching" % msg_body['kind'])
+                self._partitionSummary(request, SummaryReplayerFactory)
             
-        elif msg_body['kind'] == 'transfer_summary':
-            logging.debug("Received transfer_summary message, dispatching")
-            result = self._pool.apply_async(TransferSummaryFactory, (msg_body, self._config['AMQP']['url'], self._config))
-            try:
-                result.get(1)
-            except multiprocessing.TimeoutError as te:
-                self._running_jobs.append(result)
-                pass
-        
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            else:
+                logging.warning("Unknown kind of request: %s" % msg_body['kind'])
+                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+                return
+        except Exception as e:
+            # A request that can not be partitioned, such as one with
+            # invalid dates, would otherwise stop the daemon, and be
+            # redelivered to the next one
+            logging.error("Unable to partition request: %s" % str(e))
+            self._sendControlMessage(msg_body, {'status': 'error', 'stage': 'finished', 'message': str(e)})
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            return
+        
+        if not self._ack_on_completion:
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
         
 
 
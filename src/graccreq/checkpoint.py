@@ -0,0 +1,86 @@
+"""
+Local store of replay checkpoints.
+
+A checkpoint records how far a replay got: the position to continue the
+query from, and the number of records published before it.  Replays of
+requests carrying a ``job_id`` save one every few pages, and a replay of
+the same request resumes from it instead of starting over.
+
+Every partition of a request has a checkpoint of its own.  A partition that
+finished keeps a completed checkpoint, so that running the job again only
+replays the partitions that did not finish.  The checkpoints are removed
+once every partition of the request has finished.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+def checkpointKey(msg):
+    """
+    Key of the checkpoint of a request, or of a partition of one.
+
+    :param dict msg: The request message
+    :return str: The key
+    """
+    return "%s/%s/%s/%s" % (msg['job_id'], msg.get('kind'), msg.get('from'), msg.get('to'))
+
+
+class CheckpointStore(object):
+    """
+    Checkpoints kept as small JSON files in a directory.
+    """
+
+    def __init__(self, directory):
+        """
+        :param str directory: Directory holding the checkpoints, created if needed
+        """
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, key):
+        """
+        :param str key: Key of the checkpoint
+        :return dict: The saved state, or None if there is no checkpoint
+        """
+        try:
+            with open(self._path(key), 'r') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (IOError, ValueError):
+            return None
+        if checkpoint.get('key') != key:
+            return None
+        return checkpoint['state']
+
+    def save(self, key, state):
+        """
+        Save a checkpoint, replacing the previous one atomically.
+
+        :param str key: Key of the checkpoint
+        :param dict state: JSON serializable state
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as checkpoint_file:
+                json.dump({'key': key, 'state': state}, checkpoint_file)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            logging.error("Unable to save checkpoint %s: %s" % (key, str(e)))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def remove(self, key):
+        """
+        Remove a checkpoint, once its replay has finished.
+
+        :param str key: Key of the checkpoint
+        """
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
@@ -4,6 +4,9 @@ import sys
 from datetime import datetime, timedelta
 import string
 import random
+import io
+import collections
+from .compression import decompress
 
 
 
@@ -29,6 +32,13 @@ class Client:
         self.messages_received = 0
         self.last_messages = 0
         
+        # Flow control: records granted to each credit request, the most
+        # records granted but not yet received, and the requests waiting
+        self.credit = None
+        self.credit_window = None
+        self.granted = 0
+        self.credit_requests = collections.deque()
+        
         
     def _createQueues(self, create_data):
         """
@@ -82,19 +92,65 @@ class Client:
         # Receives the control messages
         body_parsed = json.loads(body)
         self.channel.basic_ack(delivery_tag=method.delivery_tag)
-        if body_parsed['stage'] == "finished":
+        if body_parsed['stage'] == "credit":
+            if 'returned' in body_parsed:
+                # A replayer finished without using all of its credits
+                self.granted -= body_parsed['returned']
+                if body_parsed.get('requested'):
+                    if body_parsed['queue'] in self.credit_requests:
+                        self.credit_requests.remove(body_parsed['queue'])
+                    else:
+                        # The grant was sent, but will never be used
+                        self.granted -= self.credit
+            else:
+                self.credit_requests.append(body_parsed['queue'])
+            self._grantCredit()
+        elif body_parsed['stage'] == "finished":
             def deadline_reached():
                 #print "Deadline reached"
                 self.channel.stop_consuming()
             self.conn.call_later(1, deadline_reached)
         
+    def _grantCredit(self):
+        """
+        Grant credits to the waiting replayers, as long as fewer than
+        credit_window granted records have not been received yet.
+        """
+        while self.credit_requests and self.granted - self.messages_received < self.credit_window:
+            queue = self.credit_requests.popleft()
+            self.granted += self.credit
+            self.channel.basic_publish('', queue, json.dumps({'credit': self.credit}),
+                                       pika.BasicProperties(content_type='text/json',
+                                                            delivery_mode=1))
+        
     def _getDataMessage(self, channel, method, properties, body):
         """
         Receives the data messages
         """
         self.channel.basic_ack(delivery_tag=method.delivery_tag)
-        self.messages_received += 1
-        self.callbackDataMessage(body)
+        body = decompress(body, properties.content_encoding)
+        if properties.content_type == 'application/x-ndjson':
+            # A batch of newline separated records
+            for record in body.split(b'\n'):
+                self.messages_received += 1
+                self.callbackDataMessage(record)
+        elif properties.content_type == 'application/msgpack':
+            # One or more msgpack records
+            import msgpack
+            for record in msgpack.Unpacker(io.BytesIO(body), raw=False):
+                self.messages_received += 1
+                self.callbackDataMessage(record)
+        elif properties.content_type == 'application/vnd.apache.arrow.stream':
+            # Arrow record batches are handed over as they are
+            import pyarrow.ipc
+            for batch in pyarrow.ipc.open_stream(body):
+                self.messages_received += batch.num_rows
+                self.callbackDataMessage(batch)
+        else:
+            self.messages_received += 1
+            self.callbackDataMessage(body)
+        if self.credit_requests:
+            self._grantCredit()
         
     def _checkStatus(self):
         """
@@ -110,16 +166,35 @@ class Client:
             
         
         
-    def query(self, from_date, to_date, kind, getMessage=None, destination_exchange=None, destination_key=None):
+    def query(self, from_date, to_date, kind, getMessage=None, destination_exchange=None, destination_key=None,
+              batch=None, encoding=None, confirm=False, format=None, job_id=None, credit=None, credit_window=None,
+              filter=None, source=None):
         """
         Query the remote agents for data.
         
         :param datetime from_date: A python datetime object representing the begininng of the query's time interval.
         :param datetime to_date: A python datetime object representing the end of the query's time interval
-        :param str kind: The kind of request.  Either "raw", "summary", or "transfer_summary"
+        :param str kind: The kind of request.  Either "raw", "summary", "transfer_summary",
+            or a kind of summary in the daemon's configuration
         :param function getMessage: A callback to send the received records.
         :param str destination_exchange: The name of the exchange to send data to.
         :param str destination_key: The routing key to use for destination.
+        :param dict batch: Pack records into batches of up to ``records`` records or ``bytes`` bytes,
+            for example ``{'records': 500}``.  getMessage still receives one record at a time.
+        :param str encoding: Compress the messages with ``gzip`` or ``zstd``.  getMessage receives
+            the decompressed records.
+        :param bool confirm: Ask the replayer to use publisher confirms.  The finished control message
+            then includes the number of records the broker confirmed.
+        :param str format: ``msgpack`` or ``arrow`` to receive binary records instead of JSON.  getMessage
+            receives a dict for each msgpack record, and a ``pyarrow.RecordBatch`` for each Arrow batch.
+        :param str job_id: Identifier of the request.  If the daemon keeps checkpoints, sending the same
+            request with the same job_id again resumes an interrupted replay.
+        :param int credit: Turn on flow control, granting this many records at a time to the replayers.
+            Only useful with getMessage.
+        :param int credit_window: Most records granted but not yet received.  Defaults to 4 times credit.
+        :param dict filter: Only replay raw records matching this query, for example
+            ``{'query': {'query_string': {'query': 'VOName:cms'}}}``.
+        :param source: Fields of raw records to receive, as a list, or a dict of ``includes`` and ``excludes``.
         
         Either getMessage is None, or both destination_exchange and destination_key are None.  getMessage is used
         to retrieve data inline, while destination_exchange and destination_key are used to route traffic elsewhere.
@@ -150,6 +225,25 @@ class Client:
             msg["routing_key"] = self.data_key
         msg["control"] = self.control_exchange
         msg["control_key"] = self.control_key
+        if batch:
+            msg["batch"] = batch
+        if encoding:
+            msg["encoding"] = encoding
+        if confirm:
+            msg["confirm"] = True
+        if format:
+            msg["format"] = format
+        if job_id:
+            msg["job_id"] = job_id
+        if filter:
+            msg["filter"] = filter
+        if source:
+            msg["source"] = source
+        if credit:
+            msg["credit"] = credit
+            self.credit = credit
+            self.credit_window = credit_window or 4 * credit
+            self.granted = self.messages_received
         
         # Now listen to the queues
         self.callbackDataMessage = getMessage
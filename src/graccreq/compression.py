@@ -0,0 +1,55 @@
+"""
+Compression of message bodies, shared by the replayers and the client.
+
+``gzip`` is always available.  ``zstd`` requires the optional zstandard
+module; replayers without it fall back to gzip, and mark the messages
+accordingly in their ``content_encoding``.
+"""
+import gzip
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def getCompressor(encoding):
+    """
+    Find the compression to use for a requested encoding.
+
+    :param str encoding: Encoding asked for by the request, or None
+    :return tuple: The encoding actually used (or None), and a function
+        compressing a bytes body
+    """
+    if not encoding:
+        return None, None
+    if encoding == 'zstd':
+        if zstandard is not None:
+            return 'zstd', zstandard.ZstdCompressor().compress
+        logging.warning("zstandard is not installed, compressing with gzip instead")
+        encoding = 'gzip'
+    if encoding == 'gzip':
+        return 'gzip', lambda body: gzip.compress(body, compresslevel=6)
+
+    logging.warning("Unknown encoding %s, sending uncompressed messages" % encoding)
+    return None, None
+
+
+def decompress(body, encoding):
+    """
+    Decompress a message body according to its content encoding.
+
+    :param bytes body: Body of the message
+    :param str encoding: ``content_encoding`` of the message, or None
+    :return bytes: The decompressed body
+    """
+    if not encoding:
+        return body
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("Received a zstd compressed message, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise ValueError("Unknown content encoding %s" % encoding)
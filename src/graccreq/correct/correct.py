@@ -16,7 +16,7 @@ class Corrections:
     The corrections are fetched and cached when the class is instantiated. Call
     fetch_corrections() to refresh the cache.
     """
-    def __init__(self, uri, index, doc_type, match_fields, source_field, dest_field, regex=False):
+    def __init__(self, uri, index, doc_type, match_fields, source_field, dest_field, regex=False, client=None):
         """
         :param str uri: base URI to Elasticsearch REST API
         :param str index: Elasticsearch index to fetch corrections from.
@@ -26,6 +26,7 @@ class Corrections:
         :param str source_field: Field name in the lookup index containing the corrected name.
         :param str dest_field: Field name in the document .
         :param bool regex: Whether to treat the match as a regular expression
+        :param OpenSearch client: Client to fetch the corrections with.  If None, a client for uri is created.
         """
         self.es_uri = uri
         self.es_index = index
@@ -34,6 +35,7 @@ class Corrections:
         self.source_field = source_field
         self.dest_field = dest_field
         self.regex = regex
+        self.client = client
 
         self.fetch_corrections()
 
@@ -42,17 +44,22 @@ class Corrections:
         Fetch corrections from Elasticsearch and cache them. Successive calls will overwrite the cache.
 
         Corrections are stored in flat dict using a lookup key generated from the match fields by _key().
+        If the fetch fails, the previous corrections are kept and ``loaded`` is False.
         """
+        previous = getattr(self, 'corrections', {})
         self.corrections = {}
+        self.loaded = False
         try:
-            client = OpenSearch(self.es_uri, timeout=300)
+            client = self.client or OpenSearch(self.es_uri, timeout=300)
             query = {"query": {"match": {"type": self.es_doc_type}}}
             s = scan(client=client, index=self.es_index, query=query, scroll='10m')
             for doc in s:
                 self._add_correction(doc)
         except OpenSearchException as e:
             logger.error('unable to fetch corrections: {}'.format(e))
+            self.corrections = previous
         else:
+            self.loaded = True
             logger.info('loaded {} corrections from {}/{}/{}'.
                         format(len(self.corrections),
                                self.es_uri,
@@ -0,0 +1,52 @@
+"""
+Page size of the composite aggregations of the summaries, adapted while
+the summary runs.
+
+A quiet day is best summarized in a few large pages, while a day with
+many distinct values in the nested fields needs small pages to keep the
+responses manageable.  The size is scaled after every page by how the
+page's latency compares to the target latency, and shrunk further if the
+page produced more records than wanted.
+"""
+
+
+class AdaptivePageSize(object):
+    """
+    Number of composite buckets to ask for in the next page.
+    """
+
+    # Most the size changes from one page to the next
+    max_step = 2.0
+
+    def __init__(self, config, initial):
+        """
+        :param dict config: The daemon's configuration
+        :param int initial: Size of the first page, unless configured
+        """
+        es_config = config.get('ElasticSearch', {})
+        self.minimum = es_config.get('summary_page_min', 10)
+        self.maximum = es_config.get('summary_page_max', 10000)
+        self.latency = es_config.get('summary_page_latency', 2.0)
+        self.max_records = es_config.get('summary_page_records', 100000)
+        self.size = self._bounded(es_config.get('summary_page_size', initial))
+
+    def _bounded(self, size):
+        return int(min(self.maximum, max(self.minimum, size)))
+
+    def update(self, seconds, buckets, records, size=None):
+        """
+        Adapt the size to a page.
+
+        :param float seconds: Time taken by the search
+        :param int buckets: Number of composite buckets in the page
+        :param int records: Number of records made from the page
+        :param int size: Size the page was asked for with, if not the current size
+        """
+        if buckets < (size or self.size):
+            # The last page of the summary says little about the others
+            return
+        factor = self.latency / max(seconds, 0.001)
+        if records > self.max_records:
+            factor = min(factor, float(self.max_records) / records)
+        factor = min(self.max_step, max(1 / self.max_step, factor))
+        self.size = self._bounded(self.size * factor)
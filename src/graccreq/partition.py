@@ -0,0 +1,72 @@
+"""
+Split the time range of a request into partitions that can be replayed in
+parallel by the worker pool.
+"""
+import datetime
+import math
+import dateutil.parser
+
+
+def splitSummaryRange(from_date, to_date, days=1):
+    """
+    Split the days covered by a summary request into windows of whole days.
+
+    Summaries always cover full days, including the day of ``to_date``.
+
+    :param str from_date: Beginning of the request, in ISO 8601
+    :param str to_date: End of the request, in ISO 8601
+    :param int days: Number of days in each window
+    :return list: ``(first_day, last_day)`` date pairs, both days included
+    """
+    first = dateutil.parser.parse(from_date).date()
+    last = dateutil.parser.parse(to_date).date()
+
+    windows = []
+    while first <= last:
+        end = min(first + datetime.timedelta(days=days - 1), last)
+        windows.append((first, end))
+        first = end + datetime.timedelta(days=1)
+    return windows
+
+
+def splitRawRange(from_date, to_date, days=1):
+    """
+    Split the time range of a raw request at midnight boundaries.
+
+    :param str from_date: Beginning of the request, in ISO 8601
+    :param str to_date: End of the request, in ISO 8601
+    :param int days: Number of days in each window
+    :return list: ``(start, end)`` datetime pairs.  The end of each window is
+        excluded, except for the last window, which ends at ``to_date``.
+    """
+    start = dateutil.parser.parse(from_date)
+    last = dateutil.parser.parse(to_date)
+
+    windows = []
+    while True:
+        midnight = datetime.datetime.combine(start.date(), datetime.time(), tzinfo=start.tzinfo)
+        end = midnight + datetime.timedelta(days=days)
+        if end >= last:
+            windows.append((start, last))
+            return windows
+        windows.append((start, end))
+        start = end
+
+
+def subdivideWindow(start, end, count, max_docs):
+    """
+    Split a window into equally long sub-windows so that each holds roughly
+    ``max_docs`` documents.
+
+    :param datetime start: Beginning of the window
+    :param datetime end: End of the window
+    :param int count: Number of documents in the window
+    :param int max_docs: Wanted number of documents in each sub-window
+    :return list: ``(start, end)`` datetime pairs
+    """
+    pieces = max(1, int(math.ceil(float(count) / max_docs)))
+    step = (end - start) / pieces
+    windows = []
+    for i in range(pieces):
+        windows.append((start + step * i, end if i == pieces - 1 else start + step * (i + 1)))
+    return windows
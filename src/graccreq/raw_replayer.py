@@ -1,11 +1,16 @@
 import pika
-import json
 import sys
 import logging
-from opensearchpy import OpenSearch
-from opensearchpy import Search
+from opensearchpy import helpers
+from opensearchpy import Search, Q
+from opensearchpy.exceptions import NotFoundError
 import traceback
+import queue
+import threading
+import functools
 from . import replayer
+from .partition import subdivideWindow
+from .searchclient import getClient
 
 def RawReplayerFactory(msg, parameters, config):
     # Create the raw replayer class
@@ -15,11 +20,108 @@ def RawReplayerFactory(msg, parameters, config):
         replayer.run()
     except Exception as e:
         logging.error(traceback.format_exc())
+        return {'status': 'error', 'message': str(e)}
+    return replayer.status()
+
+
+def planRawPartitions(windows, config, max_docs):
+    """
+    Count the records in each window of a raw request, and split the windows
+    holding more than ``max_docs`` records into shorter ones.
+
+    :param list windows: ``(start, end)`` datetime pairs
+    :param dict config: The daemon's configuration
+    :param int max_docs: Wanted number of records in each window
+    :return list: ``(start, end)`` datetime pairs
+    """
+    client = getClient(config)
+    planned = []
+    for start, end in windows:
+        s = Search(using=client, index=config['ElasticSearch']['raw_index'])
+        s = s.filter('range', **{'EndTime': {'gte': start, 'lt': end}})
+        count = s.count()
+        if count > max_docs:
+            logging.debug("Splitting %s - %s with %i records" % (start, end, count))
+            planned.extend(subdivideWindow(start, end, count, max_docs))
+        else:
+            planned.append((start, end))
+    return planned
+
+
+def consumeSlices(slices, page_size=1000, pages=4):
+    """
+    Iterate over several slices of a query at once.  Each slice is consumed
+    by a thread of its own, which hands the hits over in pages through a
+    bounded queue, so that slices stop querying while the caller is busy.
+
+    :param list slices: Functions returning an iterator over the hits of a slice
+    :param int page_size: Number of hits in each page
+    :param int pages: Number of pages of each slice that may wait in the queue
+    :return: Iterator over the hits of all slices, in no particular order
+    """
+    waiting = queue.Queue(maxsize=pages * len(slices))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up once the caller stopped iterating, rather than block forever
+        while not stop.is_set():
+            try:
+                waiting.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def consume(iterate):
+        try:
+            page = []
+            for hit in iterate():
+                page.append(hit)
+                if len(page) >= page_size:
+                    put(page)
+                    page = []
+                if stop.is_set():
+                    return
+            put(page)
+            put(done)
+        except Exception as e:
+            put(e)
+
+    threads = [threading.Thread(target=consume, args=(iterate,), daemon=True) for iterate in slices]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            item = waiting.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                for hit in item:
+                    yield hit
+    finally:
+        stop.set()
+
+
+class _PageEnd(object):
+    """
+    Marks the end of a page among the hits of a slice.
+    """
+    def __init__(self, slice_id, sort):
+        self.slice_id = slice_id
+        self.sort = sort
 
 
 class RawReplayer(replayer.Replayer):
-    def __init__(self, message, parameters, config):
-        super(RawReplayer, self).__init__(message, parameters)
+    
+    # Only the parts of a search response that the replay needs.  Hits are
+    # read as plain dicts, and their _source is published as it is.
+    filter_path = 'hits.hits._source,hits.hits.sort,_scroll_id,_shards'
+    
+    def __init__(self, message, parameters, config, sink=None):
+        super(RawReplayer, self).__init__(message, parameters, config, sink)
         self._config = config
         
     def run(self):
@@ -33,33 +135,238 @@ class RawReplayer(replayer.Replayer):
         # Query elsaticsearch and send the data to the destination
         logging.info("Sending response to %s with routing key %s" % (self.msg['destination'], self.msg['routing_key']))
         try:
-            for record in self._queryElasticsearch(self.msg['from'], self.msg['to'], None):
-                self.sendMessage(json.dumps(record.to_dict()))
-        except Exception as e:
-            logging.error("Exception caught in query ES: %s" % str(e))
+            try:
+                after = self.loadCheckpoint()
+                if not self.completed:
+                    for record in self._queryElasticsearch(self.msg['from'], self.msg['to'], self._filterQuery(), after):
+                        self.sendRecord(record.get('_source', {}))
+            except Exception as e:
+                # Keep the checkpoint, so that the request can be resumed
+                logging.error("Exception caught in query ES: %s" % str(e))
+                raise e
             
+            self.flush()
+            self.completeCheckpoint()
+            self.sendFinishedMessage()
+        finally:
+            # Unused credits go back to the client, even if the replay failed
+            self._returnCredit()
         
-        self.sendControlMessage({'status': 'ok', 'stage': 'finished'})
-        
-        self.conn.close()
+        self.close()
         
         return
         
     def on_return(self, channel, method, properties, body):
         sys.stderr.write("Got returned message\n")
         
-    def _queryElasticsearch(self, from_date, to_date, query):
-        logging.debug("Connecting to ES")
-        client = OpenSearch()
+    def _filterQuery(self):
+        """
+        The query in the ``filter`` of the request, if it has one.  The filter
+        is either a query, or a search body holding one in ``query``.
+        
+        :return dict: The query, or None
+        """
+        filter = self.msg.get('filter')
+        if not filter:
+            return None
+        return filter.get('query', filter)
+        
+    def _queryElasticsearch(self, from_date, to_date, query, after=None):
+        client = getClient(self._config)
         
         logging.debug("Beginning search")
         s = Search(using=client, index=self._config['ElasticSearch']['raw_index'])
-        s = s.filter('range', **{'EndTime': {'from': from_date, 'to': to_date }})
+        if self.msg.get('to_exclusive', False):
+            # Partitions of a larger request do not include their end
+            s = s.filter('range', **{'EndTime': {'gte': from_date, 'lt': to_date }})
+        else:
+            s = s.filter('range', **{'EndTime': {'from': from_date, 'to': to_date }})
+        if query:
+            # In filter context, the cluster neither scores nor sorts by the query
+            s = s.filter(Q(query))
+        
+        # Only fetch the fields the request asked for.  ``source`` is a list
+        # of fields, or a dict of ``includes`` and ``excludes``.
+        source = self.msg.get('source')
+        if isinstance(source, dict):
+            s = s.source(includes=source.get('includes', []), excludes=source.get('excludes', []))
+        elif source:
+            s = s.source(source)
         
         logging.debug("About to execute query:\n%s" % str(s.to_dict()))
         
-        for hit in s.scan():
-            yield hit
+        if self._config['ElasticSearch'].get('raw_engine', 'scroll') == 'pit':
+            for hit in self._pitSearch(client, s, after):
+                yield hit
+        elif self.checkpoints:
+            # A scroll can not be resumed, so page through the sorted records instead
+            for hit in self._searchAfter(client, s, after):
+                yield hit
+        else:
+            for hit in self._scan(client, s):
+                yield hit
+            
+    def _searchPage(self, client, search, index=None):
+        """
+        Run a search, and return its hits as dicts.
+        
+        :param OpenSearch client: The client
+        :param Search search: The search
+        :param str index: Index to search, None in a point in time
+        :return list: The hits
+        """
+        response = client.search(index=index, body=search.to_dict(), filter_path=self.filter_path)
+        # Without any hits, the filtered response has no hits at all
+        return response.get('hits', {}).get('hits', [])
+            
+    def _scan(self, client, search):
+        """
+        Scroll through the records, in raw_slices parallel slices.
+        
+        :param OpenSearch client: The client
+        :param Search search: The search
+        """
+        es_config = self._config['ElasticSearch']
+        page_size = es_config.get('raw_page_size', 1000)
+        scan = functools.partial(helpers.scan, client, index=es_config['raw_index'],
+                                 scroll=es_config.get('raw_scroll', '5m'), size=page_size,
+                                 filter_path=self.filter_path, scroll_kwargs={'filter_path': self.filter_path})
+        slices = es_config.get('raw_slices', 1)
+        if slices <= 1:
+            return scan(query=search.to_dict())
+        logging.debug("Scrolling in %i slices" % slices)
+        return consumeSlices([functools.partial(scan, query=search.extra(slice={'id': i, 'max': slices}).to_dict())
+                              for i in range(slices)], page_size)
+            
+    def _pitSearch(self, client, search, after=None):
+        """
+        Page through the records sorted by EndTime in a point in time, in
+        raw_slices parallel slices.  A point in time holds fewer resources
+        on the cluster than a scroll, and is kept alive by every page.
+        
+        A point in time still expires after raw_scroll without a search,
+        for example while the publisher is blocked.  A new one is then
+        opened, and every slice continues after its last record.  Records
+        added to the index in the meantime may be replayed as well.
+        
+        The position reported to :meth:`pageDone` holds the sort key of
+        the last record sent of each slice.
+        
+        :param OpenSearch client: The client
+        :param Search search: The search
+        :param dict after: Position to resume from, or None
+        """
+        es_config = self._config['ElasticSearch']
+        keep_alive = es_config.get('raw_scroll', '5m')
+        slices = es_config.get('raw_slices', 1)
+        positions = [None] * slices
+        if after:
+            if len(after.get('slices', [])) == slices:
+                positions = list(after['slices'])
+            else:
+                logging.warning("Checkpoint was saved with a different number of slices, starting over")
+                self.sent = 0
+        
+        def openPit():
+            return client.create_pit(index=es_config['raw_index'], params={'keep_alive': keep_alive})['pit_id']
+        
+        # The point in time shared by the slices, whether it was deleted, and
+        # the lock protecting them
+        pit = [openPit()]
+        closed = [False]
+        lock = threading.Lock()
+        
+        def renewPit(expired):
+            """
+            The point in time to continue in, or None once the search is closed.
+            """
+            with lock:
+                if closed[0]:
+                    return None
+                if pit[0] == expired:
+                    logging.warning("Point in time expired, opening a new one")
+                    pit[0] = openPit()
+                return pit[0]
+        
+        tiebreaker = es_config.get('raw_tiebreaker', '_id')
+        # A search in a point in time must not name the index
+        search = search.index().sort('EndTime', tiebreaker)[:es_config.get('raw_page_size', 1000)]
+        
+        def pages(slice_id):
+            sliced = search.extra(slice={'id': slice_id, 'max': slices}) if slices > 1 else search
+            sort = positions[slice_id]
+            pit_id = pit[0]
+            renewed = False
+            while True:
+                page = sliced.extra(pit={'id': pit_id, 'keep_alive': keep_alive})
+                if sort:
+                    page = page.extra(search_after=sort)
+                try:
+                    hits = self._searchPage(client, page)
+                except NotFoundError:
+                    if renewed:
+                        raise
+                    # Continue after the last record of the slice in a new point in time
+                    pit_id = renewPit(pit_id)
+                    if pit_id is None:
+                        # The search was closed while the slice was searching
+                        return
+                    renewed = True
+                    continue
+                renewed = False
+                if not hits:
+                    return
+                for hit in hits:
+                    yield hit
+                sort = hits[-1]['sort']
+                yield _PageEnd(slice_id, sort)
+        
+        if slices > 1:
+            logging.debug("Searching in %i slices" % slices)
+            hits = consumeSlices([functools.partial(pages, i) for i in range(slices)],
+                                 es_config.get('raw_page_size', 1000))
+        else:
+            hits = pages(0)
+        try:
+            for hit in hits:
+                if isinstance(hit, _PageEnd):
+                    # Every record of the page has been sent by now
+                    positions[hit.slice_id] = hit.sort
+                    self.pageDone({'slices': list(positions)})
+                else:
+                    yield hit
+        finally:
+            hits.close()
+            # Slice threads may still be searching, they must not open
+            # another point in time once this one is deleted
+            with lock:
+                closed[0] = True
+                pit_id = pit[0]
+            try:
+                client.delete_pit(body={'pit_id': [pit_id]})
+            except Exception as e:
+                logging.warning("Unable to delete point in time: %s" % str(e))
+            
+    def _searchAfter(self, client, search, after=None):
+        """
+        Page through the records sorted by EndTime, reporting the sort key
+        of the last record of each page to :meth:`pageDone`.
+        
+        :param OpenSearch client: The client
+        :param Search search: The search
+        :param list after: Sort key of the record to continue after, or None
+        """
+        tiebreaker = self._config['ElasticSearch'].get('raw_tiebreaker', '_id')
+        search = search.sort('EndTime', tiebreaker)[:self._config['ElasticSearch'].get('raw_page_size', 1000)]
+        while True:
+            page = search.extra(search_after=after) if after else search
+            hits = self._searchPage(client, page, self._config['ElasticSearch']['raw_index'])
+            if not hits:
+                return
+            for hit in hits:
+                yield hit
+            after = hits[-1]['sort']
+            self.pageDone(after)
         
 
         
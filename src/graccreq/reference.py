@@ -0,0 +1,135 @@
+"""
+Reference data used to enrich summary records.
+
+Building the OIM lookups and the corrections means several downloads, XML
+parses and an Elasticsearch scan.  Rather than doing that for every request,
+each worker process keeps one copy and refreshes it in the background once it
+is older than ``[General] reference_ttl`` seconds.  A copy whose corrections
+could not be loaded is only kept until a complete copy is loaded, which is
+tried again every ``[General] reference_retry`` seconds.
+"""
+import logging
+import threading
+import time
+
+from graccreq.oim import projects, OIMTopology, voinfo, nsfscience
+from graccreq.correct import Corrections
+from graccreq.searchclient import getClient
+
+
+class ReferenceData(object):
+    """
+    The OIM information and name corrections, loaded from the configuration.
+    """
+
+    def __init__(self, config):
+        """
+        :param dict config: The daemon's configuration
+        """
+        # Initialize the project information
+        self.project = projects.OIMProjects(url=config['OIM_URLs'].get('projects'))
+
+        # Initialize the OIM Topology information
+        self.topology = OIMTopology.OIMTopology(url=config['OIM_URLs'].get('oimtopology'))
+
+        # Initialize the OIM VO information
+        self.oimvoinfo = voinfo.OIMVOInfo(url=config['OIM_URLs'].get('voinfo'))
+
+        # Intialize the OIM NSF Information
+        self.nsfscience = nsfscience.NSFScience(url=config['OIM_URLs'].get('nsfscience'))
+
+        # Initiatlize name corrections
+        self.corrections = []
+        for c in config.get('Corrections', []):
+            self.corrections.append(Corrections(uri=config['ElasticSearch'].get('uri', 'http://localhost:9200'),
+                                                index=c['index'],
+                                                doc_type=c['doc_type'],
+                                                match_fields=c['match_fields'],
+                                                source_field=c['source_field'],
+                                                dest_field=c['dest_field'],
+                                                regex=c.get('regex', False),
+                                                client=getClient(config)))
+
+        # Whether every correction table was fetched
+        self.complete = all(c.loaded for c in self.corrections)
+        self.loaded = time.time()
+
+
+# The reference data of this process, and the lock protecting the refresh
+_reference = None
+_refreshing = False
+_retry_at = 0
+_lock = threading.Lock()
+
+
+def _refresh(config):
+    """
+    Build a new copy of the reference data, and swap it in when it is ready.
+    """
+    global _reference, _refreshing, _retry_at
+    try:
+        reference = ReferenceData(config)
+        if not reference.complete:
+            raise ValueError("corrections could not be loaded")
+        with _lock:
+            _reference = reference
+        logging.info("Refreshed reference data")
+    except Exception as e:
+        logging.error("Unable to refresh reference data, keeping the old copy: %s" % str(e))
+        with _lock:
+            _retry_at = time.time() + _retryDelay(config)
+    finally:
+        with _lock:
+            _refreshing = False
+
+
+def _retryDelay(config):
+    return config.get('General', {}).get('reference_retry', 60)
+
+
+def getReferenceData(config):
+    """
+    Return the reference data for this process, loading it on first use.
+
+    If the data is older than the configured TTL, or its corrections could
+    not be loaded, a background thread starts loading a fresh copy while the
+    current one is returned.
+
+    :param dict config: The daemon's configuration
+    :return ReferenceData: The reference data
+    """
+    global _reference, _refreshing, _retry_at
+    ttl = config.get('General', {}).get('reference_ttl', 3600)
+
+    with _lock:
+        reference = _reference
+        stale = reference is not None and (time.time() - reference.loaded > ttl or not reference.complete)
+        if stale and not _refreshing and time.time() >= _retry_at:
+            _refreshing = True
+            refresher = threading.Thread(target=_refresh, args=(config,), daemon=True)
+            refresher.start()
+
+    if reference is None:
+        # Nothing to fall back on, so load it in the foreground
+        reference = ReferenceData(config)
+        with _lock:
+            _reference = reference
+            if not reference.complete:
+                logging.error("Unable to load the corrections, retrying in the background")
+                _retry_at = time.time() + _retryDelay(config)
+
+    return reference
+
+
+def warm(config):
+    """
+    Load the reference data ahead of the first request.  Used as the worker
+    pool's initializer, so failures are logged and loading is retried by the
+    first job instead.
+
+    :param dict config: The daemon's configuration
+    """
+    try:
+        getReferenceData(config)
+    except Exception as e:
+        logging.error("Unable to load reference data: %s" % str(e))
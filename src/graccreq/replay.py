@@ -0,0 +1,137 @@
+"""
+Replay records straight to local files, without a broker in the path.
+
+``graccreq-replay`` splits the requested range into days, and replays the
+days in a pool of worker processes with the same replayers the daemon
+uses.  Each day is written to its own file in the output directory, named
+after the kind of replay and the day.  Summaries grouped by another field
+than the one selecting their records, like transfers, are replayed into a
+single file for the whole range.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import traceback
+
+import toml
+
+from . import reference
+from .partition import splitSummaryRange, splitRawRange
+from .raw_replayer import RawReplayer
+from .summary_replayer import SummaryReplayer
+from .transfer_summary import TransferSummary
+from .summaries import summaryDefinitions
+from .sink import FileSink, formats
+
+
+# Replayer class of each kind of request, the other summaries in the
+# configuration are replayed by SummaryReplayer
+replayers = {'raw': RawReplayer, 'summary': SummaryReplayer, 'transfer_summary': TransferSummary}
+
+
+def replayToFile(msg, config, output, format):
+    """
+    Replay one day of a request into a file.  Runs in a worker process.
+
+    :param dict msg: The request message of the day
+    :param dict config: The daemon's configuration
+    :param str output: Directory of the files
+    :param str format: Format of the files, see :mod:`graccreq.sink`
+    :return dict: The status of the replay, and the path of the file
+    """
+    path = os.path.join(output, "%s-%s" % (msg['kind'], msg['day']))
+    sink = FileSink(path, format, config.get('General', {}).get('serializer'))
+    try:
+        replayer = replayers.get(msg['kind'], SummaryReplayer)(msg, None, config, sink)
+        replayer.run()
+        sink.close()
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        sink.abort()
+        return {'status': 'error', 'message': str(e), 'day': msg['day']}
+    return dict(replayer.status(), path=sink.path, day=msg['day'])
+
+
+def planDays(kind, from_date, to_date, definition=None):
+    """
+    Split a request into one message for each day.
+
+    A summary grouped by another field than the one selecting its records is
+    not split, a day's row would be summed from records of several days, and
+    written once to each of their files.
+
+    :param str kind: Kind of the request
+    :param str from_date: Beginning of the request, in ISO 8601
+    :param str to_date: End of the request, in ISO 8601
+    :param SummaryDefinition definition: Definition of the summary, for summaries
+    :return list: The messages
+    """
+    msg = {'kind': kind, 'destination': None, 'routing_key': None}
+    days = []
+    if kind == 'raw':
+        for start, end in splitRawRange(from_date, to_date):
+            days.append(dict(msg, to_exclusive=True, day=start.date().isoformat(),
+                             **{'from': start.isoformat(), 'to': end.isoformat()}))
+        # The end of the request itself is included
+        days[-1]['to_exclusive'] = False
+    else:
+        ranges = splitSummaryRange(from_date, to_date)
+        if ranges and definition is not None and definition.date_field != definition.time_field:
+            ranges = [(ranges[0][0], ranges[-1][1])]
+        for first_day, last_day in ranges:
+            day = first_day.isoformat()
+            if last_day != first_day:
+                day += '_' + last_day.isoformat()
+            days.append(dict(msg, day=day, **{'from': first_day.isoformat(), 'to': last_day.isoformat()}))
+    return days
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay GRACC records into local files")
+    parser.add_argument("-c", "--configuration", help="Configuration file location",
+                        default="/etc/graccreq/config.toml", dest='config')
+    parser.add_argument("-k", "--kind", default='raw',
+                        help="Kind of records to replay: raw, or a kind of summary in the configuration")
+    parser.add_argument("-f", "--from", dest='from_date', required=True,
+                        help="Beginning of the replay, in ISO 8601")
+    parser.add_argument("-t", "--to", dest='to_date', required=True,
+                        help="End of the replay, in ISO 8601")
+    parser.add_argument("-o", "--output", default='.', help="Directory of the output files")
+    parser.add_argument("--format", choices=sorted(formats), default='ndjson.gz',
+                        help="Format of the output files")
+    parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, 'r') as config_file:
+        config = toml.loads(config_file.read())
+    definitions = summaryDefinitions(config)
+    if args.kind != 'raw' and args.kind not in definitions:
+        parser.error("unknown kind %s" % args.kind)
+    os.makedirs(args.output, exist_ok=True)
+
+    days = planDays(args.kind, args.from_date, args.to_date, definitions.get(args.kind))
+    failed = 0
+    records = 0
+    # Only summaries need the reference data
+    initializer = None if args.kind == 'raw' else reference.warm
+    pool = multiprocessing.Pool(processes=args.processes, initializer=initializer, initargs=(config,))
+    try:
+        results = [pool.apply_async(replayToFile, (msg, config, args.output, args.format)) for msg in days]
+        for result in results:
+            status = result.get()
+            if status['status'] != 'ok':
+                failed += 1
+                logging.error("Replay of %s failed: %s" % (status['day'], status['message']))
+            else:
+                records += status['records']
+                logging.info("Wrote %i records to %s" % (status['records'], status['path']))
+    finally:
+        pool.close()
+        pool.join()
+
+    logging.info("Replayed %i records in %i days, %i failed" % (records, len(days), failed))
+    sys.exit(1 if failed else 0)
@@ -1,6 +1,11 @@
 import logging
 import pika
 import json
+import collections
+import time
+from . import compression
+from .serializer import getSerializer, ArrowEncoder
+from .checkpoint import CheckpointStore, checkpointKey
 
 
 
@@ -9,14 +14,95 @@ class Replayer(object):
     Base for all replayers.  It provides functions for sending messages to the control
     channel, creating and sending data to the destination.
     """
-    def __init__(self, message, parameters):
+    
+    # Seconds to wait for the client to grant credits before giving up
+    credit_timeout = 600
+    
+    def __init__(self, message, parameters, config=None, sink=None):
         self.msg = message
         self.parameters = parameters
+        general = (config or {}).get('General', {})
+        
+        # The request may ask for a binary format instead of JSON.  Arrow
+        # records are collected into record batches of batch records rows.
+        self.format = self.msg.get('format', 'json')
+        self.arrow = None
+        if self.format == 'arrow':
+            self.arrow = ArrowEncoder()
+            self._rows = []
+        self.serializer = getSerializer('msgpack' if self.format == 'msgpack' else general.get('serializer'))
+        
         self.control = False
+        self.control_exchange = None
         if 'control' in self.msg and self.msg['control']:
-            self.control = True
             self.control_exchange = self.msg['control']
             self.control_key = self.msg['control_key']
+            # Partitions of a larger request leave the starting and finished
+            # messages to the OverMind, which knows when every partition is done
+            self.control = not self.msg.get('_partition', False)
+        
+        # With flow control, every record needs a credit granted by the
+        # client.  Credits are asked for on the control exchange, and
+        # granted on a queue of our own.
+        self.flow_control = bool(self.msg.get('credit')) and self.control_exchange is not None
+        self.credits = 0
+        self._credit_requested = False
+        self._credit_returned = False
+        self._blocked = False
+        
+        # Coalesced requests are published to several destinations
+        self.destinations = self.msg.get('destinations', [[self.msg.get('destination'), self.msg.get('routing_key')]])
+        
+        # Records can be packed into batches of newline separated records,
+        # of up to 'records' records or 'bytes' bytes.  Batches limited by
+        # bytes alone take any number of records.
+        batch = self.msg.get('batch') or {}
+        self.batch_bytes = batch.get('bytes', 0)
+        if self.arrow:
+            self.batch_records = batch.get('records', 1000)
+        else:
+            self.batch_records = batch.get('records', float('inf') if self.batch_bytes else 1)
+        self._batch = []
+        self._batch_size = 0
+        
+        # Message bodies are compressed if the request asked for an encoding
+        self.encoding, self._compress = compression.getCompressor(self.msg.get('encoding'))
+        
+        # Properties of messages holding a single record, and a batch of records
+        self.record_properties = pika.BasicProperties(content_type=self.serializer.content_type,
+                                                      content_encoding=self.encoding, delivery_mode=1)
+        self.batch_properties = pika.BasicProperties(content_type=self.serializer.batch_content_type,
+                                                     content_encoding=self.encoding, delivery_mode=1)
+        if self.arrow:
+            self.arrow_properties = pika.BasicProperties(content_type=self.arrow.content_type,
+                                                         content_encoding=self.encoding, delivery_mode=1)
+        
+        # With publisher confirms, up to confirm_window messages may wait
+        # for their confirmation.  Nacked messages are published again.
+        self.confirm = bool(self.msg.get('confirm', False))
+        self.confirm_window = self.msg.get('confirm_window', 1000)
+        self.confirm_retries = 3
+        self._delivery_tag = 0
+        self._unconfirmed = collections.OrderedDict()
+        self._nacked = []
+        
+        # Number of records sent, and confirmed by the broker for each destination
+        self.sent = 0
+        self.confirmed = collections.Counter()
+        
+        # Requests with a job id save a checkpoint every checkpoint_interval
+        # pages of the query, and resume from it when they are run again
+        self.checkpoints = None
+        self.completed = False
+        if self.msg.get('job_id') and general.get('checkpoint_dir'):
+            self.checkpoints = CheckpointStore(general['checkpoint_dir'])
+            self.checkpoint_key = checkpointKey(self.msg)
+            self.checkpoint_interval = general.get('checkpoint_interval', 10)
+            self._pages = 0
+        
+        # Records are written to the sink instead of being published, if
+        # one is given.  No connection to the broker is made then.
+        self.sink = sink
         
         self.conn = None
             
@@ -25,29 +111,327 @@ class Replayer(object):
         Create the connection to the rabbitmq server.
         
         """
-        if not self.conn:
+        if not self.conn and not self.sink:
             parameters = pika.URLParameters(self.parameters)
             self.conn = pika.adapters.blocking_connection.BlockingConnection(parameters)
             self.chan = self.conn.channel()
             self.chan.add_on_return_callback(self.on_return)
+            if self.confirm:
+                self._selectConfirm()
+            # Stop publishing while the broker is short on resources
+            self.conn.add_on_connection_blocked_callback(self._onBlocked)
+            self.conn.add_on_connection_unblocked_callback(self._onUnblocked)
+            if self.flow_control:
+                result = self.chan.queue_declare(queue='', exclusive=True, auto_delete=True)
+                self.credit_queue = result.method.queue
+                self.chan.basic_consume(queue=self.credit_queue, on_message_callback=self._onCredit, auto_ack=True)
+                
+    def _onBlocked(self, connection, frame):
+        logging.warning("Connection blocked by the broker, pausing the replay")
+        self._blocked = True
+        
+    def _onUnblocked(self, connection, frame):
+        logging.info("Connection unblocked, resuming the replay")
+        self._blocked = False
+        
+    def _onCredit(self, channel, method, properties, body):
+        """
+        Receives credits granted by the client.
+        """
+        self.credits += json.loads(body)['credit']
+        self._credit_requested = False
+        
+    def _requestCredit(self):
+        """
+        Ask the client for more credits, unless a request is already waiting.
+        """
+        if self._credit_requested:
+            return
+        self._credit_requested = True
+        self._basicPublish(self.control_exchange, self.control_key,
+                           json.dumps({'status': 'ok', 'stage': 'credit', 'queue': self.credit_queue}),
+                           pika.BasicProperties(content_type='text/json', delivery_mode=1))
+        
+    def _takeCredit(self):
+        """
+        Use up the credit for one record.  When half the credits are used, more
+        are requested, and when none are left, wait until the client grants some.
+        The client only grants more once it has received the records, so the
+        records waiting in the current batch are sent before waiting.
+        """
+        if not self.flow_control:
+            return
+        if not self.conn:
+            self.createConnection()
+        if self.credits <= self.msg['credit'] // 2:
+            self._requestCredit()
+        if self.credits <= 0:
+            if self.arrow:
+                self._sendRows()
+            self._sendBatch()
+        started = time.time()
+        while self.credits <= 0:
+            if time.time() - started > self.credit_timeout:
+                raise Exception("No credits granted by the client for %i seconds" % self.credit_timeout)
+            self.conn.process_data_events(time_limit=1)
+        self.credits -= 1
+        
+    def _returnCredit(self):
+        """
+        Hand the unused credits back to the client, so that it can grant them to
+        others.  If more credits were requested, the client cancels that request,
+        or writes off its grant if it is already on the way.  The credits are
+        only returned once, whether the replay finished or failed.
+        """
+        if not self.flow_control or not self.conn or self._credit_returned:
+            return
+        self._credit_returned = True
+        self._basicPublish(self.control_exchange, self.control_key,
+                           json.dumps({'status': 'ok', 'stage': 'credit', 'queue': self.credit_queue,
+                                       'returned': self.credits, 'requested': self._credit_requested}),
+                           pika.BasicProperties(content_type='text/json', delivery_mode=1))
+        self.credits = 0
+                
+    def _selectConfirm(self):
+        """
+        Turn on publisher confirms.
+        
+        The blocking channel's own confirm mode waits for every publish to be
+        confirmed.  Turning it on for the underlying channel instead lets
+        publishes continue while the confirmations arrive in :meth:`_onConfirm`.
+        """
+        selected = []
+        self.chan._impl.confirm_delivery(ack_nack_callback=self._onConfirm, callback=selected.append)
+        while not selected:
+            self.conn.process_data_events(time_limit=1)
+            
+    def _onConfirm(self, frame):
+        """
+        Called when the broker acks or nacks published messages.
+        
+        :param pika.frame.Method frame: The Basic.Ack or Basic.Nack frame
+        """
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._unconfirmed else []
+        
+        for tag in tags:
+            exchange, routing_key, body, properties, records, attempt = self._unconfirmed.pop(tag)
+            if isinstance(method, pika.spec.Basic.Nack):
+                self._nacked.append((exchange, routing_key, body, properties, records, attempt + 1))
+            else:
+                self.confirmed[(exchange, routing_key)] += records
+                
+    def _basicPublish(self, exchange, routing_key, body, properties, records=0, attempt=0):
+        """
+        Publish a message, keeping track of it until it is confirmed.
+        
+        :param str exchange: Exchange to publish to
+        :param str routing_key: Routing key of the message
+        :param bytes body: Body of the message
+        :param pika.BasicProperties properties: Properties of the message
+        :param int records: Number of records in the message
+        :param int attempt: Number of times the message was nacked before
+        """
+        self.chan.basic_publish(exchange, routing_key, body, properties)
+        if not self.confirm:
+            return
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = (exchange, routing_key, body, properties, records, attempt)
+        while len(self._unconfirmed) >= self.confirm_window:
+            self._processConfirms()
+            
+    def _processConfirms(self):
+        """
+        Wait for confirmations, and publish the nacked messages again.
+        """
+        self.conn.process_data_events(time_limit=1)
+        nacked, self._nacked = self._nacked, []
+        for exchange, routing_key, body, properties, records, attempt in nacked:
+            if attempt > self.confirm_retries:
+                raise Exception("Message to %s was nacked %i times" % (exchange, attempt))
+            logging.warning("Publishing nacked message to %s again" % exchange)
+            self._basicPublish(exchange, routing_key, body, properties, records, attempt)
+            
+    def waitForConfirms(self):
+        """
+        Wait until the broker has confirmed every published message.
+        """
+        while self.confirm and (self._unconfirmed or self._nacked):
+            self._processConfirms()
+            
+    def loadCheckpoint(self):
+        """
+        Load the checkpoint of a previous run of this request.  If that run
+        finished, :attr:`completed` is set and nothing needs to be replayed.
+        
+        :return: The position to resume the query from, or None to start from the beginning
+        """
+        if not self.checkpoints:
+            return None
+        state = self.checkpoints.load(self.checkpoint_key)
+        if not state:
+            return None
+        self.sent = state['sent']
+        if state.get('completed'):
+            logging.info("Skipping %s, completed with %i records" % (self.checkpoint_key, state['sent']))
+            self.completed = True
+            return None
+        logging.info("Resuming %s after %i records" % (self.checkpoint_key, state['sent']))
+        return state['position']
+            
+    def pageDone(self, position):
+        """
+        Called by the query when every record before ``position`` has been
+        passed on.  Every checkpoint_interval pages, the records are flushed
+        and a checkpoint saved.
+        
+        :param position: JSON serializable position to resume the query from
+        """
+        if not self.checkpoints:
+            return
+        self._pages += 1
+        if self._pages % self.checkpoint_interval == 0:
+            self.flush()
+            self.checkpoints.save(self.checkpoint_key, {'position': position, 'sent': self.sent})
+            
+    def completeCheckpoint(self):
+        """
+        Mark the replay as completed once every record has been published,
+        so that running the job again skips it.
+        """
+        if self.checkpoints:
+            self.checkpoints.save(self.checkpoint_key, {'completed': True, 'sent': self.sent})
+            
+    def status(self):
+        """
+        Status of the replay, as returned to the OverMind and sent in the
+        finished control message.
+        
+        :return dict: The status, and the number of records sent and confirmed
+        """
+        status = {'status': 'ok', 'records': self.sent}
+        if self.confirm:
+            status['confirmed'] = dict(self.confirmed)
+        return status
+            
+    def sendRecord(self, record):
+        """
+        Serialize a record and send it to the destination in the query message.
+        
+        :param dict record: The record
+        """
+        if self.sink:
+            self.sent += 1
+            self.sink.write(record)
+            return
+        if self.arrow:
+            self._takeCredit()
+            self.sent += 1
+            self._rows.append(record)
+            if len(self._rows) >= self.batch_records:
+                self._sendRows()
+            return
+        self.sendMessage(self.serializer.dumps(record))
+            
+    def _sendRows(self):
+        """
+        Send the records waiting for the current Arrow record batch, if any.
+        """
+        if not self._rows:
+            return
+        self._publish(self.arrow.encode(self._rows), self.arrow_properties, len(self._rows))
+        self._rows = []
             
     def sendMessage(self, msg):
         """
         Send message (or data) to the destination in the query message.
         
+        If the request asked for batches, the message is added to the current
+        batch, which is sent once it is full.  Call :meth:`flush` to send the
+        last batch.
+        
         :param str msg: Stringified message to send to remote receiver.  Should be json.
         
+        """
+        self._takeCredit()
+        self.sent += 1
+        if self.batch_records <= 1 and not self.batch_bytes:
+            self._publish(msg, self.record_properties, 1)
+            return
+        
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        self._batch.append(msg)
+        self._batch_size += len(msg) + 1
+        if len(self._batch) >= self.batch_records or (self.batch_bytes and self._batch_size >= self.batch_bytes):
+            self._sendBatch()
+            
+    def _sendBatch(self):
+        """
+        Send the records waiting in the current batch, if any.
+        """
+        if not self._batch:
+            return
+        self._publish(self.serializer.batch_separator.join(self._batch), self.batch_properties, len(self._batch))
+        self._batch = []
+        self._batch_size = 0
+            
+    def flush(self):
+        """
+        Send the last batch, and wait until every message is confirmed if
+        the request asked for publisher confirms.
+        """
+        if self.sink:
+            self.sink.flush()
+            return
+        if self.arrow:
+            self._sendRows()
+        self._sendBatch()
+        self.waitForConfirms()
+            
+    def _publish(self, body, properties, records):
+        """
+        Publish a body to every destination of the request.
+        
+        :param bytes body: Body of the message
+        :param pika.BasicProperties properties: Properties of the message
+        :param int records: Number of records in the body
         """
         if not self.conn:
             self.createConnection()
+        while self._blocked:
+            self.conn.process_data_events(time_limit=1)
+        if self._compress:
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            body = self._compress(body)
         try:
-            self.chan.basic_publish(self.msg['destination'], self.msg['routing_key'], msg,
-                                 pika.BasicProperties(content_type='text/json',
-                                 delivery_mode=1))
+            for destination, routing_key in self.destinations:
+                self._basicPublish(destination, routing_key, body, properties, records)
         except Exception as e:
             logging.error("Exception caught in basic_publish: %s" % str(e))
             raise e
             
+    def close(self):
+        """
+        Close the connection to the rabbitmq server, if one was made.
+        """
+        if self.conn:
+            self.conn.close()
+            
+    def sendFinishedMessage(self):
+        """
+        Send the finished control message, with the number of confirmed
+        records if the request asked for publisher confirms.
+        """
+        self._returnCredit()
+        finished = {'status': 'ok', 'stage': 'finished'}
+        if self.confirm:
+            finished['confirmed'] = sum(self.confirmed.values())
+        self.sendControlMessage(finished)
             
     def sendControlMessage(self, control_msg):
         """
@@ -65,8 +449,8 @@ class Replayer(object):
         
         try:
             logging.debug("Sending command to control exchange %s" % self.control_exchange)
-            self.chan.basic_publish(self.control_exchange, self.control_key, json.dumps(control_msg),
-                                 pika.BasicProperties(content_type='text/json',
-                                           delivery_mode=1))
+            self._basicPublish(self.control_exchange, self.control_key, json.dumps(control_msg),
+                               pika.BasicProperties(content_type='text/json',
+                                                    delivery_mode=1))
         except Exception as e:
             logging.error("Exception caught in sending start msg to control channel %s: %s" % (self.control_exchange, str(e)))
\ No newline at end of file
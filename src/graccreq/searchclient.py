@@ -0,0 +1,59 @@
+"""
+OpenSearch clients shared within a process.
+
+Every client has its own pool of keep-alive connections, and a new
+connection costs a TCP and TLS handshake.  Rather than building a client for
+every query, each process keeps one client for the ``[ElasticSearch]``
+configuration, used by the replayers and the corrections alike.
+"""
+import json
+import os
+import threading
+
+from opensearchpy import OpenSearch
+
+
+# The clients of this process, by their settings, and the lock protecting them
+_clients = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def clientSettings(config):
+    """
+    Settings of the client for a configuration.
+
+    :param dict config: The daemon's configuration
+    :return dict: Keyword arguments of ``OpenSearch``
+    """
+    es_config = config.get('ElasticSearch', {})
+    return {
+        'hosts': es_config.get('uri', 'http://localhost:9200'),
+        'timeout': es_config.get('timeout', 300),
+        # Ask the cluster for gzip compressed responses
+        'http_compress': es_config.get('http_compress', False),
+        'max_retries': es_config.get('max_retries', 3),
+        'retry_on_timeout': es_config.get('retry_on_timeout', False),
+        # Sliced queries use a connection for each slice
+        'maxsize': max(es_config.get('connections', 10), es_config.get('raw_slices', 1)),
+    }
+
+
+def getClient(config):
+    """
+    The client of this process for a configuration, created on first use.
+
+    :param dict config: The daemon's configuration
+    :return OpenSearch: The client
+    """
+    global _clients, _pid
+    settings = clientSettings(config)
+    key = json.dumps(settings, sort_keys=True)
+    with _lock:
+        if _pid != os.getpid():
+            # Connections inherited from the parent process can not be shared
+            _clients = {}
+            _pid = os.getpid()
+        if key not in _clients:
+            _clients[key] = OpenSearch(**settings)
+        return _clients[key]
@@ -0,0 +1,153 @@
+"""
+Sinks writing replayed records to local files instead of publishing them.
+
+A sink replaces the AMQP destination of a replayer: every record handed
+to :meth:`Replayer.sendRecord` is written to the sink.  Files are written
+under a temporary name and renamed when the sink is closed, so a file with
+its final name is always complete.
+
+``ndjson`` files hold one JSON record per line, ``ndjson.gz`` files are the
+same compressed with gzip, and ``parquet`` files require the optional
+pyarrow module.
+"""
+import gzip
+import os
+
+from .serializer import getSerializer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# File extension of each format
+formats = {'ndjson': '.ndjson', 'ndjson.gz': '.ndjson.gz', 'parquet': '.parquet'}
+
+
+class FileSink(object):
+    """
+    Write records to a single local file.
+    """
+
+    def __init__(self, path, format='ndjson', serializer=None, row_group=10000):
+        """
+        :param str path: Path of the file, without the extension of the format
+        :param str format: ``ndjson``, ``ndjson.gz`` or ``parquet``
+        :param str serializer: Serializer of ndjson records, see :func:`getSerializer`
+        :param int row_group: Number of records in each row group of a Parquet file
+        """
+        if format not in formats:
+            raise ValueError("Unknown output format %s" % format)
+        if format == 'parquet' and pyarrow is None:
+            raise ValueError("Parquet output was requested, but pyarrow is not installed")
+        self.format = format
+        self.path = path + formats[format]
+        self._tmp_path = self.path + '.tmp'
+        self.records = 0
+
+        self._file = None
+        self._rows = []
+        self.row_group = row_group
+        if format == 'parquet':
+            # Row groups are written to parts of their own until the schema
+            # of the whole file is known
+            self._parts = []
+        else:
+            self.serializer = getSerializer(serializer)
+            if format == 'ndjson.gz':
+                self._file = gzip.open(self._tmp_path, 'wb', compresslevel=6)
+            else:
+                self._file = open(self._tmp_path, 'wb')
+
+    def write(self, record):
+        """
+        :param dict record: The record
+        """
+        self.records += 1
+        if self._file is None:
+            self._rows.append(record)
+            if len(self._rows) >= self.row_group:
+                self._writeRows()
+            return
+        line = self.serializer.dumps(record)
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        self._file.write(line + b'\n')
+
+    def _writeRows(self):
+        """
+        Write the waiting records as one part of the Parquet file, with the
+        columns of these records.
+        """
+        if not self._rows:
+            return
+        path = "%s.%i" % (self._tmp_path, len(self._parts))
+        names = {}
+        for row in self._rows:
+            names.update(dict.fromkeys(row))
+        columns = {name: [row.get(name) for row in self._rows] for name in names}
+        pyarrow.parquet.write_table(pyarrow.Table.from_pydict(columns), path)
+        self._parts.append(path)
+        self._rows = []
+
+    def _joinParts(self):
+        """
+        Write the parts into the Parquet file, one row group each.
+
+        The schema of the file has the columns of every part, with types
+        widened to hold the values of every part.  Records missing a column
+        get a null.
+        """
+        schemas = [pyarrow.parquet.read_schema(path) for path in self._parts]
+        schema = pyarrow.unify_schemas(schemas, promote_options='permissive')
+        with pyarrow.parquet.ParquetWriter(self._tmp_path, schema) as writer:
+            for path in self._parts:
+                table = pyarrow.parquet.read_table(path)
+                columns = []
+                for field in schema:
+                    if field.name in table.column_names:
+                        columns.append(table.column(field.name).cast(field.type))
+                    else:
+                        columns.append(pyarrow.nulls(table.num_rows, field.type))
+                writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+                os.remove(path)
+        self._parts = []
+
+    def flush(self):
+        """
+        Write the buffered records to the file.
+        """
+        if self._file is not None:
+            self._file.flush()
+        else:
+            self._writeRows()
+
+    def close(self):
+        """
+        Finish the file, and give it its final name.
+        """
+        if self._file is not None:
+            self._file.close()
+        else:
+            self._writeRows()
+            if not self._parts:
+                # No records, but the file should still exist
+                pyarrow.parquet.write_table(pyarrow.table({}), self._tmp_path)
+            else:
+                self._joinParts()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """
+        Throw away a file that could not be completed.
+        """
+        if self._file is not None:
+            self._file.close()
+        else:
+            for path in self._parts:
+                if os.path.exists(path):
+                    os.remove(path)
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
@@ -0,0 +1,110 @@
+"""
+Definitions of the kinds of summaries.
+
+A summary groups the raw records of an index by day and by a list of
+dimensions, and sums a list of metrics in every group.  The job and transfer
+summaries are built in, and more kinds are defined in ``[Summaries.<kind>]``
+sections of the configuration::
+
+    [Summaries.payload_summary]
+    index = 'gracc.osg.payload-*'
+    # Field selecting the records of a request, and field of the day
+    time_field = 'EndTime'
+    date_field = 'EndTime'
+    dimensions = ['VOName', 'ProbeName']
+    metrics = ['WallDuration', 'Njobs']
+    # Number of the dimensions grouped in the composite aggregation
+    composite_dimensions = 1
+
+    [Summaries.payload_summary.defaults]
+    VOName = 'N/A'
+    Njobs = 1
+
+A section named after a built in kind changes only the keys it sets.
+Dimensions without a default are 'N/A' when missing, metrics and the day 0.
+"""
+import collections
+import json
+
+
+SummaryDefinition = collections.namedtuple('SummaryDefinition', [
+    'kind', 'index', 'time_field', 'date_field', 'interval', 'missing_date',
+    'dimensions', 'metrics', 'composite_dimensions'])
+SummaryDefinition.__doc__ = """
+A kind of summary.  ``dimensions`` and ``metrics`` are lists of
+``[name, default]`` pairs, and ``dimensions`` starts with the date field.
+"""
+
+
+# The summaries of job records
+_job_summary = {
+    'index_option': 'raw_index',
+    'default_index': 'gracc.osg.raw-*',
+    'time_field': 'EndTime',
+    'date_field': 'EndTime',
+    'dimensions': ['VOName', 'ProjectName', 'DN', 'Processors', 'GPUs', 'ResourceType', 'CommonName',
+                   'Host_description', 'Resource_ExitCode', 'Grid', 'ReportableVOName', 'ProbeName',
+                   'SiteName'],
+    'metrics': ['WallDuration', 'CpuDuration_user', 'CpuDuration_system', 'CoreHours', 'Njobs', 'CpuDuration'],
+    'defaults': {'Processors': 1, 'GPUs': 0, 'Resource_ExitCode': 0, 'Njobs': 1},
+}
+
+# The summaries of transfer records, which are grouped by the day they started
+_transfer_summary = {
+    'index_option': 'transfer_index',
+    'default_index': 'gracc.osg-transfer.raw-*',
+    'time_field': 'EndTime',
+    'date_field': 'StartTime',
+    'missing_date': False,
+    'dimensions': ['VOName', 'ProjectName', 'ProbeName', 'CommonName', 'Resource_Protocol', 'Status',
+                   'Resource_IsNew', 'Network_storageUnit', 'Grid', 'DN'],
+    'metrics': ['Njobs', 'Network', 'WallDuration'],
+    'defaults': {'Status': 0, 'Njobs': 1},
+}
+
+builtin_summaries = {'summary': _job_summary, 'transfer_summary': _transfer_summary}
+
+
+def _definition(kind, section, es_config):
+    """
+    Make the definition of a kind from its configuration section.
+    """
+    index = section.get('index') or es_config.get(section.get('index_option', ''), section.get('default_index'))
+    for key, value in (('index', index), ('time_field', section.get('time_field')),
+                       ('dimensions', section.get('dimensions')), ('metrics', section.get('metrics'))):
+        if not value:
+            raise ValueError("Summary %s has no %s" % (kind, key))
+    defaults = section.get('defaults', {})
+    date_field = section.get('date_field', section['time_field'])
+    dimensions = [[date_field, defaults.get(date_field, 0)]]
+    dimensions += [[name, defaults.get(name, "N/A")] for name in section['dimensions']]
+    metrics = [[name, defaults.get(name, 0)] for name in section['metrics']]
+    return SummaryDefinition(kind, index, section['time_field'], date_field,
+                             section.get('interval', '1d'), section.get('missing_date', True),
+                             dimensions, metrics, section.get('composite_dimensions', 3))
+
+
+def summaryDefinitions(config):
+    """
+    The kinds of summaries of a configuration.
+
+    :param dict config: The daemon's configuration
+    :return dict: The :class:`SummaryDefinition` of each kind
+    """
+    sections = {kind: dict(section) for kind, section in builtin_summaries.items()}
+    for kind, section in config.get('Summaries', {}).items():
+        merged = dict(sections.get(kind, {}), **section)
+        merged['defaults'] = dict(sections.get(kind, {}).get('defaults', {}), **section.get('defaults', {}))
+        sections[kind] = merged
+    es_config = config.get('ElasticSearch', {})
+    return {kind: _definition(kind, section, es_config) for kind, section in sections.items()}
+
+
+def definitionKey(definition):
+    """
+    A string which changes with anything in the definition that changes the records.
+
+    :param SummaryDefinition definition: The definition
+    :return str: The key
+    """
+    return json.dumps(definition, sort_keys=True)
@@ -0,0 +1,141 @@
+"""
+Local cache of summary records, one entry for each day.
+
+The records of a day hardly ever change once the day is over, but
+summarizing them means an expensive aggregation.  Each entry is stored with
+a change marker of its day, the number of raw records and the latest time
+one of them was received, and is only used while the marker is unchanged.
+
+The entries hold the records as the aggregation made them, before the
+corrections and the OIM information are applied, so that a replay always
+uses the current corrections.  Entries are gzipped NDJSON files, and the
+least recently used ones are removed once the cache grows beyond its size.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+class SummaryCache(object):
+    """
+    Summary records of whole days, kept in a directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+        :param str directory: Directory holding the entries, created if needed
+        :param int max_bytes: Most bytes the entries take together
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, kind, day):
+        key = "%s/%s" % (kind, day.isoformat())
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.ndjson.gz')
+
+    def load(self, kind, day, marker):
+        """
+        The records of a day, if they are cached with the same marker.
+
+        :param str kind: Kind of summary
+        :param date day: The day
+        :param list marker: Change marker of the day
+        :return list: The records, or None if they are not cached
+        """
+        path = self._path(kind, day)
+        try:
+            with gzip.open(path, 'rt') as entry:
+                header = json.loads(entry.readline())
+                if header.get('marker') != marker:
+                    return None
+                records = [json.loads(line) for line in entry]
+        except (IOError, OSError, EOFError, ValueError):
+            return None
+        # Most recently used entries are removed last
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return records
+
+    def writer(self, kind, day, marker):
+        """
+        Start a new entry for a day.
+
+        :param str kind: Kind of summary
+        :param date day: The day
+        :param list marker: Change marker of the day, taken before the records were summarized
+        :return CacheWriter: Writer of the entry
+        """
+        return CacheWriter(self, self._path(kind, day), marker)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in its size.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.ndjson.gz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+class CacheWriter(object):
+    """
+    Writes the records of a day while they are replayed, and adds the entry
+    to the cache once all of them are written.
+    """
+
+    def __init__(self, cache, path, marker):
+        self.cache = cache
+        self.path = path
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self._raw = os.fdopen(fd, 'wb')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=6)
+        self._file.write(json.dumps({'marker': marker}).encode('utf-8') + b'\n')
+
+    def write(self, record):
+        """
+        :param dict record: The record, before it is corrected
+        """
+        self._file.write(json.dumps(record).encode('utf-8') + b'\n')
+
+    def commit(self):
+        """
+        Add the entry to the cache.
+        """
+        try:
+            self._file.close()
+            self._raw.close()
+            os.replace(self._tmp_path, self.path)
+        except Exception as e:
+            logging.error("Unable to cache summary in %s: %s" % (self.path, str(e)))
+            self.abort()
+            return
+        self.cache.evict()
+
+    def abort(self):
+        """
+        Throw the entry away.
+        """
+        self._file.close()
+        self._raw.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
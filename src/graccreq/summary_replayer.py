@@ -2,7 +2,7 @@ import pika
 import json
 import sys
 import logging
-from opensearchpy import OpenSearch, Search, A
+from opensearchpy import Search, A
 #from elasticsearch import Elasticsearch
 #from elasticsearch_dsl import Search, A
 #from elasticsearch_dsl.aggs import Composite
@@ -10,11 +10,17 @@ from opensearchpy import OpenSearch, Search, A
 import traceback
 from . import replayer
 import dateutil
-import copy
 import datetime
-from graccreq.oim import projects, OIMTopology, voinfo, nsfscience
+import time
+import collections
+import queue
+import threading
 import io
-from graccreq.correct import Corrections
+from graccreq.reference import getReferenceData
+from graccreq.searchclient import getClient
+from graccreq.pagesize import AdaptivePageSize
+from graccreq.summary_cache import SummaryCache
+from graccreq.summaries import summaryDefinitions, definitionKey
 
 
 def SummaryReplayerFactory(msg, parameters, config):
@@ -29,8 +35,10 @@ def SummaryReplayerFactory(msg, parameters, config):
     try:
         replayer = SummaryReplayer(msg, parameters, config)
         replayer.run()
+        result = replayer.status()
     except Exception as e:
         logging.error(traceback.format_exc())
+        result = {'status': 'error', 'message': str(e)}
     
     if 'General' in config and 'Profile' in config['General'] and config['General']['Profile']:
         logging.debug("Stopping profiler")
@@ -44,35 +52,259 @@ def SummaryReplayerFactory(msg, parameters, config):
         f.write(s.getvalue())
         f.close()
         print(s.getvalue())
+
+    return result
         
         
+# A page of a composite aggregation: its buckets, the key to continue
+# after, the seconds the search took, and the size asked for
+Page = collections.namedtuple('Page', ['buckets', 'after', 'seconds', 'size'])
+
+
+# Only the parts of an aggregation response that the summaries use: the
+# keys, document counts and metric values of the buckets, at any depth
+aggregation_filter_path = ','.join(['aggregations.comp.after_key',
+                                    'aggregations.comp.buckets.key',
+                                    'aggregations.comp.buckets.doc_count',
+                                    'aggregations.comp.buckets.**.key',
+                                    'aggregations.comp.buckets.**.doc_count',
+                                    'aggregations.comp.buckets.**.value'])
+
+
+def searchAggregations(client, index, search):
+    """
+    Run the aggregations of a search with the low-level client.  The
+    response is plain dicts, trimmed to what the summaries use.
+
+    :param OpenSearch client: The client
+    :param str index: Index to search
+    :param Search search: The search
+    :return dict: The response
+    """
+    return client.search(index=index, body=search.to_dict(), filter_path=aggregation_filter_path)
+
+
+def fetchCompositePage(run_search, size, after=None):
+    """
+    Fetch a page of the ``comp`` composite aggregation.
+
+    :param function run_search: Runs the search for a page size and a
+        composite key to start after, or None, see :func:`searchAggregations`
+    :param int size: Number of buckets to ask for
+    :param dict after: Composite key to start after, or None
+    :return Page: The page, or None once there are no more buckets
+    """
+    started = time.time()
+    # Without any buckets, the trimmed response has no aggregations at all
+    comp = run_search(size, after).get('aggregations', {}).get('comp', {})
+    buckets = comp.get('buckets')
+    if not buckets:
+        return None
+    next_after = comp.get('after_key') or buckets[-1]['key']
+    return Page(buckets, next_after, time.time() - started, size)
+
+
+def prefetchPages(fetch, after=None, depth=1):
+    """
+    Iterate over the pages of a composite aggregation.  A background thread
+    fetches up to ``depth`` pages ahead, so that the cluster works on the
+    next pages while the records of the current one are made and sent.
+
+    :param function fetch: Fetches the page after a composite key, or None
+        for the first page.  Returns a :class:`Page`, or None after the last page.
+    :param dict after: Composite key to start after, or None
+    :param int depth: Number of pages to fetch ahead, 0 to fetch each page when needed
+    :return: Iterator over the pages
+    """
+    if depth <= 0:
+        while True:
+            page = fetch(after)
+            if page is None:
+                return
+            yield page
+            after = page.after
+
+    pages = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up once the caller stopped iterating, rather than block forever
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def run(after):
+        try:
+            while not stop.is_set():
+                page = fetch(after)
+                if page is None:
+                    break
+                put(page)
+                after = page.after
+            put(done)
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=run, args=(after,), daemon=True).start()
+    try:
+        while True:
+            item = pages.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def flattenBuckets(bucket, terms, metrics):
+    """
+    Flatten the nested terms aggregations below a composite bucket into
+    records, one for each bucket of the deepest aggregation.
+
+    Each record is built once, from the keys of the buckets on the way down,
+    and yielded as soon as it is complete.  A bucket without sub-buckets
+    makes a record of the keys above it, without any metrics.
+
+    :param bucket: The composite bucket
+    :param list terms: Names of the nested terms aggregations, outermost first
+    :param list metrics: Names of the metrics in the deepest buckets
+    :return: Iterator over the records
+    """
+    last = len(terms) - 1
+    keys = [None] * len(terms)
+    stack = [iter(bucket[terms[0]]['buckets'])]
+    while stack:
+        depth = len(stack) - 1
+        child = next(stack[depth], None)
+        if child is None:
+            stack.pop()
+            continue
+        keys[depth] = child['key']
+        if depth == last:
+            record = dict(zip(terms, keys))
+            for metric in metrics:
+                record[metric] = child[metric]['value']
+            record['Count'] = child['doc_count']
+            yield record
+        elif child[terms[depth + 1]]['buckets']:
+            stack.append(iter(child[terms[depth + 1]]['buckets']))
+        else:
+            yield dict(zip(terms[:depth + 1], keys))
+
+
+class DefaultMerger(object):
+    """
+    Merges summary rows of a composite aggregation that only differ in a
+    missing value and the default filling in for it.
+
+    Documents with a field set to its default, and documents without the
+    field, end up in separate buckets of a composite aggregation, but are
+    one record of the summary.  The rows arrive in the order of their keys,
+    where a missing value comes before any other, so a row with a missing
+    value is only held back while rows that can be merged into it may still
+    follow: as long as the fields before its first missing value do not change.
+
+    A replay resumed from :meth:`resumeAfter` reads every row that could
+    still be merged into the held back rows again, and sends some of the
+    records it sent before a second time.
+    """
+
+    def __init__(self, terms, metrics):
+        """
+        :param list terms: ``[name, default]`` pairs of the grouping fields, in the order of the sources
+        :param list metrics: ``[name, default]`` pairs of the summed fields
+        """
+        self.terms = terms
+        self.metrics = [metric[0] for metric in metrics] + ['Count']
+        # Held back rows by their key with defaults.  For each length, the
+        # fields before the first missing value shared by the held back rows,
+        # their keys, and the composite key of the row before the first one.
+        self._held = {}
+        self._prefixes = {}
+        self._last = None
+
+    def add(self, values, record, key=None):
+        """
+        :param tuple values: Values of the grouping fields, None where missing
+        :param dict record: The record of the row, with defaults filled in
+        :param dict key: Composite key of the row
+        :return list: The records that are complete
+        """
+        done = []
+        for length in list(self._prefixes):
+            if values[:length] != self._prefixes[length][0]:
+                for merged in self._prefixes.pop(length)[1]:
+                    done.append(self._held.pop(merged))
+
+        merged = tuple(value if value is not None else term[1] for value, term in zip(values, self.terms))
+        if merged in self._held:
+            held = self._held[merged]
+            for metric in self.metrics:
+                held[metric] += record[metric]
+        elif None in values:
+            length = values.index(None)
+            self._held[merged] = record
+            self._prefixes.setdefault(length, (values[:length], [], self._last))[1].append(merged)
+        else:
+            done.append(record)
+        self._last = key
+        return done
+
+    def resumeAfter(self, after):
+        """
+        Composite key to resume from without losing the held back rows.
+
+        :param dict after: Composite key of the last row added
+        :return dict: ``after`` if no rows are held back, else the key of the
+            row before the first held back one, or None if that is the first row
+        """
+        if not self._prefixes:
+            return after
+        # Groups are created in the order of their first rows
+        return next(iter(self._prefixes.values()))[2]
+
+    def finish(self):
+        """
+        :return list: The rows still held back
+        """
+        done = list(self._held.values())
+        self._held = {}
+        self._prefixes = {}
+        return done
+
+
 class SummaryReplayer(replayer.Replayer):
-    def __init__(self, message, parameters, config):
-        super(SummaryReplayer, self).__init__(message, parameters)
+    """
+    Replays summaries of any kind in :func:`summaryDefinitions`, by default
+    the kind of the request.
+    """
+    summary_kind = 'summary'
+
+    def __init__(self, message, parameters, config, sink=None):
+        super(SummaryReplayer, self).__init__(message, parameters, config, sink)
         self._config = config
+        self.definition = summaryDefinitions(config)[message.get('kind') or self.summary_kind]
+
+        # Summaries of whole days are cached if summary_cache_dir is set
+        general = config.get('General', {})
+        self.cache = None
+        if general.get('summary_cache_dir'):
+            self.cache = SummaryCache(general['summary_cache_dir'],
+                                      general.get('summary_cache_bytes', 1024 ** 3))
         
-        # Initialize the project information
-        self.project = projects.OIMProjects(url=self._config['OIM_URLs'].get('projects'))
-
-        # Initialize the OIM Topology information
-        self.topology = OIMTopology.OIMTopology(url=self._config['OIM_URLs'].get('oimtopology'))
-
-        # Initialize the OIM VO information
-        self.oimvoinfo = voinfo.OIMVOInfo(url=self._config['OIM_URLs'].get('voinfo'))
-
-        # Intialize the OIM NSF Information
-        self.nsfscience = nsfscience.NSFScience(url=self._config['OIM_URLs'].get('nsfscience'))
-
-        # Initiatlize name corrections
-        self.corrections = []
-        for c in self._config.get('Corrections',[]):
-            self.corrections.append(Corrections(uri=self._config['ElasticSearch'].get('uri','http://localhost:9200'),
-                                                index=c['index'],
-                                                doc_type=c['doc_type'],
-                                                match_fields=c['match_fields'],
-                                                source_field=c['source_field'],
-                                                dest_field=c['dest_field'],
-                                                regex=c.get('regex', False)))
+        # The OIM information and corrections are loaded once per worker
+        reference = getReferenceData(self._config)
+        self.project = reference.project
+        self.topology = reference.topology
+        self.oimvoinfo = reference.oimvoinfo
+        self.nsfscience = reference.nsfscience
+        self.corrections = reference.corrections
         
     def run(self):
         
@@ -86,26 +318,106 @@ class SummaryReplayer(replayer.Replayer):
         # Query elsaticsearch and send the data to the destination
         logging.info("Sending response to %s with routing key %s" % (self.msg['destination'], self.msg['routing_key']))
         try:
-            for record in self._queryElasticsearch(self.msg['from'], self.msg['to'], None):
-                for c in self.corrections:
-                    c.correct(record)
-                self.addProperties(record)
-                self.sendMessage(json.dumps(record))
-        except Exception as e:
-            logging.error("Exception caught in query ES: %s" % str(e))
-            logging.exception("Failed message: {}".format(json.dumps(record)))
-            raise e
+            try:
+                after = self.loadCheckpoint()
+                records = self._summaryRecords(after) if not self.completed else []
+                for record in records:
+                    for c in self.corrections:
+                        c.correct(record)
+                    self.addProperties(record)
+                    self.sendRecord(record)
+            except Exception as e:
+                logging.error("Exception caught in query ES: %s" % str(e))
+                logging.exception("Failed message: {}".format(json.dumps(record)))
+                raise e
             
+            self.flush()
+            self.completeCheckpoint()
+            self.sendFinishedMessage()
+        finally:
+            # Unused credits go back to the client, even if the replay failed
+            self._returnCredit()
         
-        self.sendControlMessage({'status': 'ok', 'stage': 'finished'})
-        
-        self.conn.close()
+        self.close()
         
 
 
     def on_return(self, channel, method, properties, body):
         sys.stderr.write("Got returned message\n")
 
+    def _summaryRecords(self, after=None):
+        """
+        The records of the request, before they are corrected.
+
+        Without a cache, or for requests saving checkpoints, the whole
+        request is summarized at once.  Otherwise the request is summarized
+        day by day, and days which are over are read from the cache while
+        their change marker is the same.  Summaries grouped by another field
+        than the one selecting their records are not cached, a day's rows
+        would be split over several entries.
+
+        :param after: Position to resume the summary from
+        """
+        definition = self.definition
+        if not self.cache or self.checkpoints or definition.date_field != definition.time_field:
+            for record in self._queryElasticsearch(self.msg['from'], self.msg['to'], None, after):
+                yield record
+            return
+
+        client = getClient(self._config)
+        day = dateutil.parser.parse(self.msg['from']).date()
+        last = dateutil.parser.parse(self.msg['to']).date()
+        today = datetime.datetime.utcnow().date()
+        while day <= last:
+            if day >= today:
+                # Records of the day are still coming in
+                for record in self._queryElasticsearch(day.isoformat(), day.isoformat(), None):
+                    yield record
+                day += datetime.timedelta(days=1)
+                continue
+
+            marker = self._dayMarker(client, day)
+            records = self.cache.load(self.definition.kind, day, marker)
+            if records is not None:
+                logging.debug("Using cached %s of %s" % (self.definition.kind, day))
+                for record in records:
+                    yield record
+            else:
+                entry = self.cache.writer(self.definition.kind, day, marker)
+                try:
+                    for record in self._queryElasticsearch(day.isoformat(), day.isoformat(), None):
+                        # Written before the record is corrected
+                        entry.write(record)
+                        yield record
+                except BaseException:
+                    entry.abort()
+                    raise
+                entry.commit()
+            day += datetime.timedelta(days=1)
+
+    def _dayMarker(self, client, day):
+        """
+        Change marker of a day: the number of records in the index, the
+        latest time one of them was received, and the summary's definition.
+
+        :param client: The OpenSearch client
+        :param date day: The day
+        :return list: The marker
+        """
+        es_config = self._config['ElasticSearch']
+        index = self.definition.index
+        s = Search(index=index)
+        s = s.filter('range', **{self.definition.time_field: {'gte': day, 'lt': day + datetime.timedelta(days=1)}})
+        s = s.extra(size=0, track_total_hits=True)
+        s.aggs.metric('changed', 'max', field=es_config.get('change_marker_field', '@received'))
+        response = client.search(index=index, body=s.to_dict(),
+                                 filter_path='hits.total,aggregations.changed.value')
+        total = response['hits']['total']
+        if isinstance(total, dict):
+            total = total['value']
+        return [total, response.get('aggregations', {}).get('changed', {}).get('value'),
+                definitionKey(self.definition)]
+
     def addProperties(self, record):
         
         # If ProjectName is "N/A", then set 
@@ -156,107 +468,145 @@ class SummaryReplayer(replayer.Replayer):
 
         return record
         
-    def _queryElasticsearch(self, from_date, to_date, query):
-        logging.debug("Connecting to ES")
-        es_uri = self._config['ElasticSearch'].get('uri', 'http://localhost:9200')
-        client = OpenSearch(es_uri, timeout=300)
+    def _scanComposite(self, client, index, search, date_source, unique_terms, metrics, after=None):
+        """
+        Summarize with a composite aggregation over every grouping field,
+        in pages of an :class:`AdaptivePageSize`.  Unlike nested terms
+        aggregations, the size of each response stays bounded.
+
+        Checkpoints are saved before the rows held back by the
+        :class:`DefaultMerger`.
+
+        :param OpenSearch client: The client
+        :param str index: Index to search
+        :param Search search: The search
+        :param A date_source: Source of the first grouping field, the day
+        :param list unique_terms: ``[name, default]`` pairs of the grouping fields
+        :param list metrics: ``[name, default]`` pairs of the summed fields
+        :param dict after: Composite key to start after, or None
+        :return: Iterator over the records, with defaults filled in
+        """
+        sources = [{unique_terms[0][0]: date_source}]
+        for term in unique_terms[1:]:
+            sources.append({term[0]: A('terms', field=term[0], missing_bucket=True)})
+        names = [term[0] for term in unique_terms]
+        page_size = AdaptivePageSize(self._config, 1000)
+        merger = DefaultMerger(unique_terms, metrics)
+
+        def run_search(size, after):
+            s = search[:0]
+            comp = s.aggs.bucket('comp', 'composite', sources=sources, size=size,
+                                 **({'after': after} if after else {}))
+            for metric in metrics:
+                comp.metric(metric[0], 'sum', field=metric[0], missing=metric[1])
+            return searchAggregations(client, index, s)
+
+        fetch = lambda after: fetchCompositePage(run_search, page_size.size, after)
+        for page in prefetchPages(fetch, after, self._config['ElasticSearch'].get('summary_prefetch', 1)):
+            sent = self.sent
+            for bucket in page.buckets:
+                key = bucket['key']
+                values = tuple(key[name] for name in names)
+                record = {name: value if value is not None else default
+                          for (name, default), value in zip(unique_terms, values)}
+                for metric in metrics:
+                    record[metric[0]] = bucket[metric[0]]['value']
+                record['Count'] = bucket['doc_count']
+                for done in merger.add(values, record, key):
+                    yield done
+            page_size.update(page.seconds, len(page.buckets), self.sent - sent, page.size)
+            position = merger.resumeAfter(page.after)
+            if position:
+                # Every record before the position has been sent by now
+                self.pageDone(position)
+
+        for done in merger.finish():
+            yield done
+
+    def _queryElasticsearch(self, from_date, to_date, query, after=None):
+        client = getClient(self._config)
+        definition = self.definition
         
         # For summaries, we only summarize full days, so strip the time from the from & to
-        # Round the date up, so we get the entire last day they requested.
+        # Round the date up, so we get the entire last day they requested, and
+        # stop before the next day, which belongs to the next partition.
         from_date = dateutil.parser.parse(from_date).date()
         to_date = dateutil.parser.parse(to_date).date() + datetime.timedelta(days=1)
 
         logging.debug("Beginning search")
-        s = Search(using=client, index=self._config['ElasticSearch']['raw_index'])
-        s = s.filter('range', **{'EndTime': {'from': from_date, 'to': to_date }})
+        index = definition.index
+        s = Search(using=client, index=index)
+        s = s.filter('range', **{definition.time_field: {'gte': from_date, 'lt': to_date }})
         if query:
             s = s.query(query)
 
         # Fill in the unique terms and metrics
-        unique_terms = [["EndTime", 0], ["VOName", "N/A"], ["ProjectName", "N/A"], ["DN", "N/A"], ["Processors", 1], ["GPUs", 0], ["ResourceType", "N/A"], ["CommonName", "N/A"], ["Host_description", "N/A"], ["Resource_ExitCode", 0], ["Grid", "N/A"], ["ReportableVOName", "N/A"], ["ProbeName", "N/A"], ["SiteName", "N/A"]]
-        metrics = [["WallDuration", 0], ["CpuDuration_user", 0], ["CpuDuration_system", 0], ["CoreHours", 0], ["Njobs", 1], ["CpuDuration", 0]]
+        unique_terms = definition.dimensions
+        metrics = definition.metrics
+        date_field = definition.date_field
 
         terms_dict = {item[0]: item[1] for item in unique_terms}
+        date_source = A('date_histogram', field=date_field, calendar_interval=definition.interval,
+                        **({'missing_bucket': True} if definition.missing_date else {}))
+
+        if self._config['ElasticSearch'].get('summary_engine', 'nested') == 'composite':
+            for record in self._scanComposite(client, index, s, date_source, unique_terms, metrics, after):
+                # Convert to iso 8601 date format
+                record[date_field] = datetime.datetime.utcfromtimestamp(record[date_field]/1000).isoformat(timespec='milliseconds') + "Z"
+                yield record
+            return
 
         # If the terms are missing, set as "N/A"
         composite_buckets = []
-        composite_buckets.append({unique_terms[0][0]: A('date_histogram', field=unique_terms[0][0], calendar_interval="1d", missing_bucket=True)})
+        composite_buckets.append({date_field: date_source})
         new_unique_terms = unique_terms[1:]
 
-        # First 3 terms, use composite
-        for term in new_unique_terms[:3]:
+        # The first terms use composite
+        for term in new_unique_terms[:definition.composite_dimensions]:
             composite_buckets.append({term[0]: A('terms', field=term[0], missing_bucket=True)})
 
-        new_unique_terms = new_unique_terms[3:]
+        new_unique_terms = new_unique_terms[definition.composite_dimensions:]
 
-        def scan_aggs(search, source_aggs, size=10):
+        def scan_aggs(search, source_aggs, page_size, after=None):
             """
             Helper function used to iterate over all possible bucket combinations of
             ``source_aggs``.  Uses the ``composite`` aggregation under the hood to perform this.
+            Starts after the composite key ``after``, if given.  The size of the pages
+            adapts to how long they take, and how many records they make, and the
+            next pages are fetched while the buckets of the current one are processed.
             """
-            def run_search(**kwargs):
+            def run_search(size, after):
                 s = search[:0]
-                curBucket = s.aggs.bucket('comp', 'composite', sources=source_aggs, size=size, **kwargs)
+                curBucket = s.aggs.bucket('comp', 'composite', sources=source_aggs, size=size,
+                                          **({'after': after} if after else {}))
                 for term in new_unique_terms:
                     curBucket = curBucket.bucket(term[0], 'terms', field=term[0], missing=term[1], size=(2**31)-1)
                 for metric in metrics:
                     curBucket.metric(metric[0], 'sum', field=metric[0], missing=metric[1])
-                return s.execute()
+                return searchAggregations(client, index, s)
 
-            response = run_search()
-            while response.aggregations.comp.buckets:
-                for b in response.aggregations.comp.buckets:
+            fetch = lambda after: fetchCompositePage(run_search, page_size.size, after)
+            for page in prefetchPages(fetch, after, self._config['ElasticSearch'].get('summary_prefetch', 1)):
+                sent = self.sent
+                for b in page.buckets:
                     yield b
-                if 'after_key' in response.aggregations.comp:
-                    after = response.aggregations.comp.after_key
-                else:
-                    after= response.aggregations.comp.buckets[-1].key
-                response = run_search(after=after)
+                page_size.update(page.seconds, len(page.buckets), self.sent - sent, page.size)
+                # Every record of the page has been sent by now
+                self.pageDone(page.after)
 
-        response = scan_aggs(s, composite_buckets, size=100)
-
-
-        def recurseBucket(curData, curBucket, index, data):
-            """
-            Recursively process the buckets down the nested aggregations
-
-            :param curData: Current 
-            :param bucket curBucket: A elasticsearch bucket object
-            :param int index: Index of the unique_terms that we are processing
-            """
-            curTerm = new_unique_terms[index][0]
-
-            # Check if we are at the end of the list
-            if not curBucket[curTerm]['buckets']:
-                # Make a copy of the data
-                nowData = copy.deepcopy(curData)
-                data.append(nowData)
-            else:
-                # Get the current key, and add it to the data
-                for bucket in curBucket[curTerm]['buckets']:
-                    nowData = copy.deepcopy(curData)
-                    nowData[curTerm] = bucket['key']
-                    if index == (len(new_unique_terms) - 1):
-                        # reached the end of the unique terms
-                        for metric in metrics:
-                            nowData[metric[0]] = bucket[metric[0]].value
-                            # Add the doc count
-                        nowData["Count"] = bucket['doc_count']
-                        data.append(nowData)
-                    else:
-                        recurseBucket(nowData, bucket, index+1, data)
+        response = scan_aggs(s, composite_buckets, AdaptivePageSize(self._config, 100), after=after)
 
 
+        term_names = [term[0] for term in new_unique_terms]
+        metric_names = [metric[0] for metric in metrics]
         for key in response:
-            for processor in key['Processors']['buckets']:
-                data = []
-                recurseBucket({"Processors": processor['key']}, processor, 1, data)
-                for record in data:
-                    record.update(key['key'].to_dict())
-                    for term, value in record.items():
-                        if value is None and term in terms_dict:
-                            record[term] = terms_dict[term]
-                    # Convert to iso 8601 date format
-                    record['EndTime'] = datetime.datetime.utcfromtimestamp(record['EndTime']/1000).isoformat(timespec='milliseconds') + "Z"
-                    yield record
+            composite_key = key['key']
+            for record in flattenBuckets(key, term_names, metric_names):
+                record.update(composite_key)
+                for term, value in record.items():
+                    if value is None and term in terms_dict:
+                        record[term] = terms_dict[term]
+                # Convert to iso 8601 date format
+                record[date_field] = datetime.datetime.utcfromtimestamp(record[date_field]/1000).isoformat(timespec='milliseconds') + "Z"
+                yield record
 
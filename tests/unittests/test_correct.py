@@ -1,6 +1,10 @@
 import unittest
+from unittest import mock
+
+from opensearchpy.exceptions import ConnectionError
 
 from graccreq.correct import Corrections
+from graccreq.correct import correct
 
 class MockCorrections(Corrections):
     def __init__(self, regex=False):
@@ -9,7 +13,32 @@ class MockCorrections(Corrections):
         self.dest_field = ''
         self.regex = regex
 
+class FailingClient(object):
+    def search(self, *args, **kwargs):
+        raise ConnectionError('N/A', 'cluster went away', None)
+
+
 class TestCorrections(unittest.TestCase):
+    def test_failed_fetch(self):
+        c = MockCorrections()
+        c.es_uri, c.es_index, c.es_doc_type = 'http://localhost:9200', 'corrections', 'vo'
+        c.corrections = {'cms': {'name': 'CMS'}}
+        c.client = FailingClient()
+        c.fetch_corrections()
+        # The previous corrections are kept, and the fetch counts as failed
+        self.assertFalse(c.loaded)
+        self.assertEqual(c.corrections, {'cms': {'name': 'CMS'}})
+
+    def test_empty_fetch(self):
+        c = MockCorrections()
+        c.es_uri, c.es_index, c.es_doc_type = 'http://localhost:9200', 'corrections', 'vo'
+        c.client = object()
+        with mock.patch.object(correct, 'scan', return_value=iter([])):
+            c.fetch_corrections()
+        # An empty table is still loaded
+        self.assertTrue(c.loaded)
+        self.assertEqual(c.corrections, {})
+
     def test_simple_corrections(self):
         c = MockCorrections()
         c.match_fields=['name']
@@ -0,0 +1,46 @@
+import unittest
+
+from graccreq.pagesize import AdaptivePageSize
+
+
+class TestAdaptivePageSize(unittest.TestCase):
+    def setUp(self):
+        self.config = {'ElasticSearch': {'summary_page_min': 10, 'summary_page_max': 1000,
+                                         'summary_page_latency': 2.0, 'summary_page_records': 5000}}
+
+    def test_initial(self):
+        self.assertEqual(AdaptivePageSize(self.config, 100).size, 100)
+        self.config['ElasticSearch']['summary_page_size'] = 5000
+        self.assertEqual(AdaptivePageSize(self.config, 100).size, 1000)
+
+    def test_fast(self):
+        # Quick pages grow, at most doubling each time, up to the maximum
+        page_size = AdaptivePageSize(self.config, 100)
+        page_size.update(0.1, 100, 100)
+        self.assertEqual(page_size.size, 200)
+        for _ in range(10):
+            page_size.update(0.1, page_size.size, 100)
+        self.assertEqual(page_size.size, 1000)
+
+    def test_slow(self):
+        page_size = AdaptivePageSize(self.config, 100)
+        page_size.update(3.0, 100, 100)
+        self.assertEqual(page_size.size, 66)
+        for _ in range(10):
+            page_size.update(30, page_size.size, 100)
+        self.assertEqual(page_size.size, 10)
+
+    def test_records(self):
+        # A fast page making too many records still shrinks the next one
+        page_size = AdaptivePageSize(self.config, 100)
+        page_size.update(0.1, 100, 8000)
+        self.assertEqual(page_size.size, 62)
+
+    def test_last_page(self):
+        page_size = AdaptivePageSize(self.config, 100)
+        page_size.update(0.1, 7, 7)
+        self.assertEqual(page_size.size, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import datetime
+import unittest
+
+from graccreq.partition import splitSummaryRange, splitRawRange, subdivideWindow
+
+
+class TestPartition(unittest.TestCase):
+    def test_summary_days(self):
+        windows = splitSummaryRange("2016-06-01T05:00:00", "2016-06-03T01:00:00")
+        self.assertEqual(windows, [(datetime.date(2016, 6, 1), datetime.date(2016, 6, 1)),
+                                   (datetime.date(2016, 6, 2), datetime.date(2016, 6, 2)),
+                                   (datetime.date(2016, 6, 3), datetime.date(2016, 6, 3))])
+
+    def test_summary_weeks(self):
+        windows = splitSummaryRange("2016-06-01", "2016-06-10", days=7)
+        self.assertEqual(windows, [(datetime.date(2016, 6, 1), datetime.date(2016, 6, 7)),
+                                   (datetime.date(2016, 6, 8), datetime.date(2016, 6, 10))])
+
+    def test_raw(self):
+        windows = splitRawRange("2016-06-01T12:00:00", "2016-06-03T06:00:00")
+        self.assertEqual(windows, [(datetime.datetime(2016, 6, 1, 12), datetime.datetime(2016, 6, 2)),
+                                   (datetime.datetime(2016, 6, 2), datetime.datetime(2016, 6, 3)),
+                                   (datetime.datetime(2016, 6, 3), datetime.datetime(2016, 6, 3, 6))])
+
+    def test_raw_single(self):
+        windows = splitRawRange("2016-06-01T12:00:00", "2016-06-01T13:00:00")
+        self.assertEqual(windows, [(datetime.datetime(2016, 6, 1, 12), datetime.datetime(2016, 6, 1, 13))])
+
+    def test_subdivide(self):
+        start = datetime.datetime(2016, 6, 1)
+        end = datetime.datetime(2016, 6, 2)
+        windows = subdivideWindow(start, end, 2500, 1000)
+        self.assertEqual(len(windows), 3)
+        self.assertEqual(windows[0][0], start)
+        self.assertEqual(windows[-1][1], end)
+        self.assertEqual(windows[0][1], windows[1][0])
+
+        self.assertEqual(subdivideWindow(start, end, 10, 1000), [(start, end)])
+
+
+if __name__ == '__main__':
+    unittest.main()
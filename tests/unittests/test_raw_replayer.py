@@ -0,0 +1,217 @@
+import threading
+import time
+import unittest
+
+from opensearchpy import Search
+from opensearchpy.exceptions import NotFoundError
+
+from graccreq.raw_replayer import RawReplayer, consumeSlices
+
+
+class FakePitClient(object):
+    """
+    Answers searches in a point in time over records with EndTime 0 to 9
+    """
+    def __init__(self, expire_at=None):
+        """
+        :param int expire_at: Number of searches after which the points in time expire
+        """
+        self.docs = [{'_id': 'id%02d' % i, '_source': {'EndTime': i}, 'sort': [i, 'id%02d' % i]}
+                     for i in range(10)]
+        self.pits = set()
+        self.created = 0
+        self.searches = 0
+        self.expire_at = expire_at
+
+    def create_pit(self, index, params=None):
+        self.created += 1
+        pit_id = 'pit%i' % self.created
+        self.pits.add(pit_id)
+        return {'pit_id': pit_id}
+
+    def delete_pit(self, body=None):
+        self.pits.difference_update(body['pit_id'])
+
+    def search(self, index=None, body=None, filter_path=None):
+        assert index is None
+        assert filter_path == RawReplayer.filter_path
+        if self.searches == self.expire_at:
+            self.pits.clear()
+            self.expire_at = None
+        if body['pit']['id'] not in self.pits:
+            raise NotFoundError(404, 'search_context_missing_exception', {})
+        self.searches += 1
+        docs = self.docs
+        if 'slice' in body:
+            docs = [d for d in docs if d['sort'][0] % body['slice']['max'] == body['slice']['id']]
+        if 'search_after' in body:
+            docs = [d for d in docs if d['sort'] > body['search_after']]
+        return {'took': 1, 'timed_out': False, 'hits': {'hits': docs[:body['size']]}}
+
+
+def searchOf(msg):
+    """
+    The search a raw replayer runs for a request
+    """
+    msg = dict({'destination': 'data', 'routing_key': 'data-key', 'kind': 'raw'}, **msg)
+    replayer = RawReplayer(msg, None, {'ElasticSearch': {'raw_index': 'gracc.osg.raw-*'}})
+    searches = []
+    replayer._scan = lambda client, search: searches.append(search) or iter([])
+    list(replayer._queryElasticsearch('2024-01-01', '2024-01-02', replayer._filterQuery()))
+    return searches[0].to_dict()
+
+
+class FakeScrollClient(object):
+    """
+    Scrolls through records with EndTime 0 to 9, two at a time
+    """
+    def __init__(self):
+        self.scrolls = {}
+
+    def _page(self, scroll_id):
+        docs, position = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (docs, position + 2)
+        return {'_scroll_id': scroll_id, '_shards': {'total': 1, 'successful': 1},
+                'hits': {'hits': [{'_source': doc} for doc in docs[position:position + 2]]}}
+
+    def search(self, index=None, body=None, scroll=None, size=None, request_timeout=None, filter_path=None):
+        assert filter_path == RawReplayer.filter_path
+        docs = [{'EndTime': i} for i in range(10)]
+        if 'slice' in body:
+            docs = [d for d in docs if d['EndTime'] % body['slice']['max'] == body['slice']['id']]
+        scroll_id = str(len(self.scrolls))
+        self.scrolls[scroll_id] = (docs, 0)
+        return self._page(scroll_id)
+
+    def scroll(self, body=None, filter_path=None):
+        return self._page(body['scroll_id'])
+
+    def clear_scroll(self, body=None, ignore=None):
+        pass
+
+
+class TestConsumeSlices(unittest.TestCase):
+    def test_all_hits(self):
+        slices = [lambda i=i: iter(range(i * 100, i * 100 + 95)) for i in range(4)]
+        hits = list(consumeSlices(slices, page_size=10, pages=1))
+        self.assertEqual(sorted(hits), [h for i in range(4) for h in range(i * 100, i * 100 + 95)])
+
+    def test_error(self):
+        def failing():
+            yield 1
+            raise ValueError("scroll expired")
+
+        with self.assertRaises(ValueError):
+            list(consumeSlices([lambda: iter(range(1000)), failing], page_size=10))
+
+    def test_stop(self):
+        # The threads of an abandoned iteration do not block forever
+        hits = consumeSlices([lambda: iter(range(100000))] * 2, page_size=10, pages=1)
+        self.assertEqual(next(hits), 0)
+        hits.close()
+
+
+class TestScan(unittest.TestCase):
+    def test_slices(self):
+        for slices in (1, 3):
+            config = {'ElasticSearch': {'raw_index': 'raw', 'raw_slices': slices, 'raw_page_size': 2}}
+            replayer = RawReplayer({'destination': 'data', 'routing_key': 'data-key'}, None, config)
+            client = FakeScrollClient()
+            hits = replayer._scan(client, Search(using=client, index='raw'))
+            self.assertEqual(sorted(h['_source']['EndTime'] for h in hits), list(range(10)))
+            self.assertEqual(len(client.scrolls), slices)
+
+
+class TestPushdown(unittest.TestCase):
+    def test_none(self):
+        search = searchOf({})
+        self.assertNotIn('_source', search)
+        self.assertEqual(len(search['query']['bool']['filter']), 1)
+
+    def test_filter(self):
+        query = {'query_string': {'query': 'VOName:cms'}}
+        for filter in ({'query': query}, query):
+            search = searchOf({'filter': filter})
+            self.assertIn(query, search['query']['bool']['filter'])
+
+    def test_source(self):
+        self.assertEqual(searchOf({'source': ['VOName', 'EndTime']})['_source'], ['VOName', 'EndTime'])
+        self.assertEqual(searchOf({'source': {'excludes': ['RawXML']}})['_source'],
+                         {'includes': [], 'excludes': ['RawXML']})
+
+
+class TestPitSearch(unittest.TestCase):
+    def createReplayer(self, slices):
+        config = {'ElasticSearch': {'raw_index': 'raw', 'raw_engine': 'pit', 'raw_slices': slices,
+                                    'raw_page_size': 3}}
+        replayer = RawReplayer({'destination': 'data', 'routing_key': 'data-key'}, None, config)
+        self.positions = []
+        replayer.pageDone = self.positions.append
+        return replayer
+
+    def test_single(self):
+        client = FakePitClient()
+        replayer = self.createReplayer(1)
+        hits = list(replayer._pitSearch(client, Search(using=client, index='raw')))
+        self.assertEqual([h['_source']['EndTime'] for h in hits], list(range(10)))
+        self.assertEqual(self.positions[-1], {'slices': [[9, 'id09']]})
+        self.assertFalse(client.pits)
+
+    def test_expired(self):
+        for slices in (1, 2):
+            # The point in time expires after the first pages, while the publisher waits
+            client = FakePitClient(expire_at=slices)
+            replayer = self.createReplayer(slices)
+            hits = list(replayer._pitSearch(client, Search(using=client, index='raw')))
+            self.assertEqual(sorted(h['_source']['EndTime'] for h in hits), list(range(10)))
+            self.assertEqual(client.created, 2)
+            self.assertFalse(client.pits)
+
+    def test_expired_again(self):
+        # New points in time are gone before they are searched
+        client = FakePitClient()
+        client.create_pit = lambda index, params=None: {'pit_id': 'gone'}
+        with self.assertRaises(NotFoundError):
+            list(self.createReplayer(1)._pitSearch(client, Search(using=client, index='raw')))
+
+    def test_close_while_searching(self):
+        # A slice still searching when the search is closed finds the point
+        # in time deleted, and does not open another one
+        class SlowSliceClient(FakePitClient):
+            release = threading.Event()
+
+            def search(self, index=None, body=None, filter_path=None):
+                if body['slice']['id'] == 1:
+                    self.release.wait(5)
+                return FakePitClient.search(self, index, body, filter_path)
+
+        client = SlowSliceClient()
+        hits = self.createReplayer(2)._pitSearch(client, Search(using=client, index='raw'))
+        next(hits)
+        hits.close()
+        client.release.set()
+        for _ in range(50):
+            if client.created > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(client.created, 1)
+        self.assertFalse(client.pits)
+
+    def test_slices_resume(self):
+        client = FakePitClient()
+        replayer = self.createReplayer(2)
+        hits = replayer._pitSearch(client, Search(using=client, index='raw'))
+        first = [next(hits)['_source']['EndTime'] for _ in range(4)]
+        hits.close()
+        self.assertFalse(client.pits)
+
+        # Every record after the last saved position of its slice is replayed again
+        position = self.positions[-1]
+        hits = list(replayer._pitSearch(client, Search(using=client, index='raw'), position))
+        done = [i for i in range(10) if position['slices'][i % 2] and i <= position['slices'][i % 2][0]]
+        self.assertTrue(set(done) <= set(first))
+        self.assertEqual(sorted(done + [h['_source']['EndTime'] for h in hits]), list(range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
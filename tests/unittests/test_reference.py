@@ -0,0 +1,92 @@
+import time
+import unittest
+from unittest import mock
+
+from graccreq import reference
+
+
+class FakeReferenceData(object):
+    created = 0
+    complete = True
+
+    def __init__(self, config):
+        FakeReferenceData.created += 1
+        self.complete = FakeReferenceData.complete
+        self.loaded = time.time()
+
+
+def waitForRefresh():
+    for _ in range(100):
+        if not reference._refreshing:
+            break
+        time.sleep(0.01)
+
+
+class TestReferenceData(unittest.TestCase):
+    def setUp(self):
+        reference._reference = None
+        reference._refreshing = False
+        reference._retry_at = 0
+        FakeReferenceData.created = 0
+        FakeReferenceData.complete = True
+
+    @mock.patch.object(reference, 'ReferenceData', FakeReferenceData)
+    def test_reused(self):
+        config = {'General': {'reference_ttl': 3600}}
+        first = reference.getReferenceData(config)
+        second = reference.getReferenceData(config)
+        self.assertIs(first, second)
+        self.assertEqual(FakeReferenceData.created, 1)
+
+    @mock.patch.object(reference, 'ReferenceData', FakeReferenceData)
+    def test_refresh(self):
+        config = {'General': {'reference_ttl': 60}}
+        first = reference.getReferenceData(config)
+        first.loaded -= 120
+
+        # The stale copy is still returned while the refresh runs
+        self.assertIs(reference.getReferenceData(config), first)
+        waitForRefresh()
+
+        self.assertIsNot(reference.getReferenceData(config), first)
+        self.assertEqual(FakeReferenceData.created, 2)
+
+    @mock.patch.object(reference, 'ReferenceData', FakeReferenceData)
+    def test_failed_corrections(self):
+        config = {'General': {'reference_ttl': 60, 'reference_retry': 30}}
+        first = reference.getReferenceData(config)
+        first.loaded -= 120
+
+        # A refresh without corrections keeps the old copy
+        FakeReferenceData.complete = False
+        reference.getReferenceData(config)
+        waitForRefresh()
+        self.assertIs(reference.getReferenceData(config), first)
+        self.assertEqual(FakeReferenceData.created, 2)
+
+        # and is tried again after the retry delay rather than the TTL
+        FakeReferenceData.complete = True
+        reference._retry_at -= 31
+        reference.getReferenceData(config)
+        waitForRefresh()
+        self.assertIsNot(reference.getReferenceData(config), first)
+        self.assertEqual(FakeReferenceData.created, 3)
+
+    @mock.patch.object(reference, 'ReferenceData', FakeReferenceData)
+    def test_incomplete_first_load(self):
+        config = {'General': {'reference_ttl': 3600, 'reference_retry': 30}}
+        FakeReferenceData.complete = False
+        first = reference.getReferenceData(config)
+        self.assertIs(reference.getReferenceData(config), first)
+
+        # With nothing else to use, the incomplete copy is replaced once the retry delay has passed
+        FakeReferenceData.complete = True
+        reference._retry_at -= 31
+        reference.getReferenceData(config)
+        waitForRefresh()
+        self.assertIsNot(reference.getReferenceData(config), first)
+        self.assertEqual(FakeReferenceData.created, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
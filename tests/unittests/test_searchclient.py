@@ -0,0 +1,29 @@
+import unittest
+from unittest import mock
+
+from graccreq import searchclient
+
+
+class TestSearchClient(unittest.TestCase):
+    def setUp(self):
+        searchclient._clients = {}
+
+    def test_shared(self):
+        config = {'ElasticSearch': {'uri': 'http://localhost:9200', 'http_compress': True}}
+        client = searchclient.getClient(config)
+        self.assertIs(searchclient.getClient(dict(config)), client)
+        self.assertIsNot(searchclient.getClient({'ElasticSearch': {'uri': 'http://other:9200'}}), client)
+
+    def test_fork(self):
+        config = {'ElasticSearch': {}}
+        client = searchclient.getClient(config)
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(searchclient.getClient(config), client)
+
+    def test_slices(self):
+        settings = searchclient.clientSettings({'ElasticSearch': {'raw_slices': 16}})
+        self.assertEqual(settings['maxsize'], 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
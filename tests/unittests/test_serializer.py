@@ -0,0 +1,26 @@
+import json
+import unittest
+
+from graccreq import serializer
+
+
+class TestSerializer(unittest.TestCase):
+    record = {'VOName': 'cms', 'DN': '/DC=org/CN=Jörg', 'Processors': 8, 'WallDuration': 1234.5,
+              'CoreHours': 1e16, 'OIM_PIName': None, 'Dedicated': True, 'Nested': {'a': [1, 2.5]}}
+
+    def test_json_compatible(self):
+        s = serializer.getSerializer('json')
+        self.assertEqual(s.dumps(self.record), json.dumps(self.record))
+        self.assertEqual(serializer.getSerializer().dumps(self.record), json.dumps(self.record))
+
+    @unittest.skipIf(serializer.orjson is None, "orjson is not installed")
+    def test_orjson(self):
+        s = serializer.getSerializer('orjson')
+        self.assertEqual(json.loads(s.dumps(self.record)), self.record)
+
+    def test_unknown(self):
+        self.assertIsInstance(serializer.getSerializer('pickle'), serializer.JSONSerializer)
+
+
+if __name__ == '__main__':
+    unittest.main()
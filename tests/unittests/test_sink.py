@@ -0,0 +1,110 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyarrow.parquet
+
+from graccreq.sink import FileSink
+from graccreq.replayer import Replayer
+from graccreq.replay import planDays
+from graccreq.summaries import summaryDefinitions
+
+
+class TestFileSink(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'raw-2024-01-01')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ndjson(self):
+        sink = FileSink(self.path, 'ndjson')
+        sink.write({'a': 1})
+        sink.write({'a': 2})
+        # Nothing has the final name until the file is complete
+        self.assertFalse(os.path.exists(sink.path))
+        sink.close()
+        with open(self.path + '.ndjson') as f:
+            self.assertEqual([json.loads(line) for line in f], [{'a': 1}, {'a': 2}])
+
+    def test_gzip(self):
+        sink = FileSink(self.path, 'ndjson.gz')
+        sink.write({'a': 1})
+        sink.close()
+        with gzip.open(self.path + '.ndjson.gz', 'rt') as f:
+            self.assertEqual(json.loads(f.read()), {'a': 1})
+
+    def test_parquet(self):
+        sink = FileSink(self.path, 'parquet', row_group=2)
+        for i in range(5):
+            sink.write({'a': i, 'b': str(i)} if i != 3 else {'a': i, 'c': 'later'})
+        sink.close()
+        table = pyarrow.parquet.read_table(self.path + '.parquet')
+        self.assertEqual(table.column_names, ['a', 'b', 'c'])
+        self.assertEqual(table.column('a').to_pylist(), [0, 1, 2, 3, 4])
+        self.assertEqual(table.column('b').to_pylist(), ['0', '1', '2', None, '4'])
+        self.assertEqual(table.column('c').to_pylist(), [None, None, None, 'later', None])
+        self.assertEqual(os.listdir(self.directory), ['raw-2024-01-01.parquet'])
+
+    def test_parquet_schema(self):
+        # A column without values in the first row group, and one of mixed
+        # integers and floats
+        sink = FileSink(self.path, 'parquet', row_group=2)
+        for record in ({'a': 1, 'b': None}, {'a': 2, 'b': None}, {'a': 3.5, 'b': 'x'}):
+            sink.write(record)
+        sink.close()
+        table = pyarrow.parquet.read_table(self.path + '.parquet')
+        self.assertEqual(table.column('a').to_pylist(), [1, 2, 3.5])
+        self.assertEqual(table.column('b').to_pylist(), [None, None, 'x'])
+
+    def test_abort(self):
+        sink = FileSink(self.path, 'ndjson')
+        sink.write({'a': 1})
+        sink.abort()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_replayer(self):
+        sink = FileSink(self.path, 'ndjson')
+        replayer = Replayer({'destination': None, 'routing_key': None}, None, sink=sink)
+        replayer.createConnection()
+        self.assertIsNone(replayer.conn)
+        for i in range(3):
+            replayer.sendRecord({'a': i})
+        replayer.flush()
+        replayer.sendFinishedMessage()
+        replayer.close()
+        sink.close()
+        self.assertEqual(replayer.status(), {'status': 'ok', 'records': 3})
+        with open(sink.path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+
+class TestPlanDays(unittest.TestCase):
+    def test_raw(self):
+        days = planDays('raw', '2024-01-01T12:00:00', '2024-01-03T06:00:00')
+        self.assertEqual([d['day'] for d in days], ['2024-01-01', '2024-01-02', '2024-01-03'])
+        self.assertEqual(days[0]['from'], '2024-01-01T12:00:00')
+        self.assertEqual(days[1]['from'], '2024-01-02T00:00:00')
+        self.assertEqual([d['to_exclusive'] for d in days], [True, True, False])
+
+    def test_summary(self):
+        days = planDays('summary', '2024-01-01T12:00:00', '2024-01-02T06:00:00')
+        self.assertEqual([(d['from'], d['to']) for d in days],
+                         [('2024-01-01', '2024-01-01'), ('2024-01-02', '2024-01-02')])
+
+    def test_transfer_summary(self):
+        # Transfers are grouped by the day they started, so the range is not split
+        definition = summaryDefinitions({})['transfer_summary']
+        days = planDays('transfer_summary', '2024-01-01T12:00:00', '2024-01-03T06:00:00', definition)
+        self.assertEqual([(d['day'], d['from'], d['to']) for d in days],
+                         [('2024-01-01_2024-01-03', '2024-01-01', '2024-01-03')])
+        days = planDays('summary', '2024-01-01', '2024-01-02', summaryDefinitions({})['summary'])
+        self.assertEqual([d['day'] for d in days], ['2024-01-01', '2024-01-02'])
+
+
+if __name__ == '__main__':
+    unittest.main()
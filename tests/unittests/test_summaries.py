@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+
+import toml
+
+from graccreq import summary_replayer
+from graccreq.summaries import summaryDefinitions
+from graccreq.summary_replayer import SummaryReplayer
+from graccreq.transfer_summary import TransferSummary
+
+from test_summary_replayer import FakeCompositeClient
+
+
+CONFIG = {'ElasticSearch': {'raw_index': 'raw', 'transfer_index': 'transfer'}}
+
+
+class TestDefinitions(unittest.TestCase):
+    def test_builtin(self):
+        definitions = summaryDefinitions(CONFIG)
+        summary = definitions['summary']
+        self.assertEqual(summary.index, 'raw')
+        self.assertEqual(summary.dimensions,
+                         [["EndTime", 0], ["VOName", "N/A"], ["ProjectName", "N/A"], ["DN", "N/A"],
+                          ["Processors", 1], ["GPUs", 0], ["ResourceType", "N/A"], ["CommonName", "N/A"],
+                          ["Host_description", "N/A"], ["Resource_ExitCode", 0], ["Grid", "N/A"],
+                          ["ReportableVOName", "N/A"], ["ProbeName", "N/A"], ["SiteName", "N/A"]])
+        self.assertEqual(summary.metrics, [["WallDuration", 0], ["CpuDuration_user", 0], ["CpuDuration_system", 0],
+                                           ["CoreHours", 0], ["Njobs", 1], ["CpuDuration", 0]])
+        transfer = definitions['transfer_summary']
+        self.assertEqual((transfer.index, transfer.time_field, transfer.date_field, transfer.missing_date),
+                         ('transfer', 'EndTime', 'StartTime', False))
+        self.assertEqual(transfer.dimensions,
+                         [["StartTime", 0], ["VOName", "N/A"], ["ProjectName", "N/A"], ["ProbeName", "N/A"],
+                          ["CommonName", "N/A"], ["Resource_Protocol", "N/A"], ["Status", 0],
+                          ["Resource_IsNew", "N/A"], ["Network_storageUnit", "N/A"], ["Grid", "N/A"], ["DN", "N/A"]])
+        self.assertEqual(transfer.metrics, [["Njobs", 1], ["Network", 0], ["WallDuration", 0]])
+
+    def test_config(self):
+        config = dict(CONFIG, **toml.loads("""
+            [Summaries.summary]
+            composite_dimensions = 5
+            [Summaries.summary.defaults]
+            VOName = 'unknown'
+
+            [Summaries.payload_summary]
+            index = 'payload'
+            time_field = 'EndTime'
+            dimensions = ['VOName']
+            metrics = ['WallDuration', 'Njobs']
+            [Summaries.payload_summary.defaults]
+            Njobs = 1
+        """))
+        definitions = summaryDefinitions(config)
+        summary = definitions['summary']
+        self.assertEqual(summary.composite_dimensions, 5)
+        self.assertEqual(summary.dimensions[1], ['VOName', 'unknown'])
+        self.assertEqual(summary.dimensions[4], ['Processors', 1])
+        payload = definitions['payload_summary']
+        self.assertEqual(payload.dimensions, [['EndTime', 0], ['VOName', 'N/A']])
+        self.assertEqual(payload.metrics, [['WallDuration', 0], ['Njobs', 1]])
+
+        with self.assertRaises(ValueError):
+            summaryDefinitions({'Summaries': {'broken': {'index': 'x', 'time_field': 'EndTime'}}})
+
+
+class TestEngine(unittest.TestCase):
+    def summarize(self, replayer_class, msg, config, docs, from_date='1970-01-02', to_date='1970-01-02'):
+        client = FakeCompositeClient(docs)
+        with mock.patch.object(summary_replayer, 'getReferenceData'), \
+                mock.patch.object(summary_replayer, 'getClient', return_value=client):
+            replayer = replayer_class(dict({'destination': 'data', 'routing_key': 'data-key'}, **msg), None, config)
+            return list(replayer._queryElasticsearch(from_date, to_date, None))
+
+    def test_kinds(self):
+        config = dict(CONFIG, ElasticSearch=dict(CONFIG['ElasticSearch'], summary_engine='composite'),
+                      Summaries={'payload_summary': {'index': 'payload', 'time_field': 'EndTime',
+                                                     'dimensions': ['VOName'], 'metrics': ['WallDuration']}})
+        docs = [{'EndTime': 86400000, 'StartTime': 0, 'VOName': 'cms', 'WallDuration': 2},
+                {'EndTime': 86400000, 'StartTime': 0, 'WallDuration': 3}]
+
+        records = self.summarize(SummaryReplayer, {'kind': 'payload_summary'}, config, docs)
+        self.assertEqual(sorted((r['EndTime'], r['VOName'], r['WallDuration']) for r in records),
+                         [('1970-01-02T00:00:00.000Z', 'N/A', 3), ('1970-01-02T00:00:00.000Z', 'cms', 2)])
+
+        records = self.summarize(TransferSummary, {}, config, docs)
+        self.assertEqual(sorted((r['StartTime'], r['VOName'], r['Njobs']) for r in records),
+                         [('1970-01-01T00:00:00.000Z', 'N/A', 1), ('1970-01-01T00:00:00.000Z', 'cms', 1)])
+
+    def test_across_midnight(self):
+        # Two transfers starting on the same day, one of them ending on the next day
+        docs = [{'StartTime': 86400000, 'EndTime': 86400000 + 3600000, 'VOName': 'cms', 'Network': 2},
+                {'StartTime': 86400000, 'EndTime': 2 * 86400000 + 3600000, 'VOName': 'cms', 'Network': 3}]
+        config = dict(CONFIG, ElasticSearch=dict(CONFIG['ElasticSearch'], summary_engine='composite'))
+        records = self.summarize(TransferSummary, {}, config, docs, '1970-01-02', '1970-01-03')
+        self.assertEqual([(r['StartTime'], r['Network'], r['Njobs']) for r in records],
+                         [('1970-01-02T00:00:00.000Z', 5, 2)])
+        # Summarized a day at a time, the same day would be published twice
+        days = [self.summarize(TransferSummary, {}, config, docs, day, day) for day in ('1970-01-02', '1970-01-03')]
+        self.assertEqual([len(records) for records in days], [1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
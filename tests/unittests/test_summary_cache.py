@@ -0,0 +1,150 @@
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from graccreq import summary_replayer
+from graccreq.summary_cache import SummaryCache
+from graccreq.summary_replayer import SummaryReplayer
+
+from test_summary_replayer import FakeCompositeClient
+
+
+DAY = datetime.date(2024, 1, 1)
+
+
+class TestSummaryCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, cache, day, marker, records):
+        entry = cache.writer('summary', day, marker)
+        for record in records:
+            entry.write(record)
+        entry.commit()
+
+    def test_marker(self):
+        cache = SummaryCache(self.directory, 1024 ** 2)
+        self.assertIsNone(cache.load('summary', DAY, [1, 2]))
+        self.store(cache, DAY, [1, 2], [{'VOName': 'cms'}, {'VOName': 'atlas'}])
+        self.assertEqual(cache.load('summary', DAY, [1, 2]), [{'VOName': 'cms'}, {'VOName': 'atlas'}])
+        self.assertIsNone(cache.load('summary', DAY, [2, 2]))
+        self.assertIsNone(cache.load('transfer_summary', DAY, [1, 2]))
+
+    def test_abort(self):
+        cache = SummaryCache(self.directory, 1024 ** 2)
+        entry = cache.writer('summary', DAY, [1, 2])
+        entry.write({'VOName': 'cms'})
+        entry.abort()
+        self.assertIsNone(cache.load('summary', DAY, [1, 2]))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_evict(self):
+        cache = SummaryCache(self.directory, 1024 ** 2)
+        records = [{'Value': 'value%i' % i, 'Index': i} for i in range(200)]
+        days = [DAY + datetime.timedelta(days=i) for i in range(3)]
+        for i, day in enumerate(days):
+            self.store(cache, day, [i], records)
+            path = cache._path('summary', day)
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        # The oldest day was used last
+        self.assertIsNotNone(cache.load('summary', days[0], [0]))
+
+        # Only room for the two most recently used days
+        size = lambda day: os.path.getsize(cache._path('summary', day))
+        cache.max_bytes = size(days[0]) + size(days[2])
+        cache.evict()
+        self.assertIsNotNone(cache.load('summary', days[0], [0]))
+        self.assertIsNone(cache.load('summary', days[1], [1]))
+        self.assertIsNotNone(cache.load('summary', days[2], [2]))
+
+
+class TestCachedSummary(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch.object(summary_replayer, 'getClient')
+    @mock.patch.object(summary_replayer, 'getReferenceData')
+    def test_days(self, getReferenceData, getClient):
+        config = {'General': {'summary_cache_dir': self.directory},
+                  'ElasticSearch': {'raw_index': 'raw'}}
+        msg = {'destination': 'data', 'routing_key': 'data-key', 'from': '2024-01-01', 'to': '2024-01-03'}
+        markers = {'2024-01-01': 10, '2024-01-02': 20, '2024-01-03': 30}
+
+        def search(index=None, body=None, filter_path=None):
+            day = body['query']['bool']['filter'][0]['range']['EndTime']['gte']
+            return {'hits': {'total': {'value': markers[str(day)]}}, 'aggregations': {'changed': {'value': 1.0}}}
+        getClient.return_value.search.side_effect = search
+
+        def summarize(replayer):
+            queried = []
+
+            def query(from_date, to_date, query, after=None):
+                self.assertEqual(from_date, to_date)
+                queried.append(from_date)
+                yield {'EndTime': from_date, 'Njobs': markers[from_date]}
+            replayer._queryElasticsearch = query
+            return [r['Njobs'] for r in replayer._summaryRecords()], queried
+
+        replayer = SummaryReplayer(msg, None, config)
+        self.assertEqual(summarize(replayer), ([10, 20, 30], ['2024-01-01', '2024-01-02', '2024-01-03']))
+        self.assertEqual(summarize(replayer), ([10, 20, 30], []))
+
+        # Only the changed day is summarized again
+        markers['2024-01-02'] = 21
+        self.assertEqual(summarize(replayer), ([10, 21, 30], ['2024-01-02']))
+
+    @mock.patch.object(summary_replayer, 'getClient')
+    @mock.patch.object(summary_replayer, 'getReferenceData')
+    def test_next_midnight(self, getReferenceData, getClient):
+        config = {'General': {'summary_cache_dir': self.directory},
+                  'ElasticSearch': {'raw_index': 'raw', 'summary_engine': 'composite'}}
+        msg = {'destination': 'data', 'routing_key': 'data-key', 'from': '1970-01-02', 'to': '1970-01-03'}
+
+        class MarkerClient(FakeCompositeClient):
+            def search(self, index=None, body=None, filter_path=None):
+                if 'aggs' in body and 'comp' in body['aggs']:
+                    return FakeCompositeClient.search(self, index, body, filter_path)
+                return {'hits': {'total': {'value': 1}}, 'aggregations': {'changed': {'value': 1.0}}}
+        getClient.return_value = MarkerClient(
+            [{'EndTime': 86400000, 'WallDuration': 2}, {'EndTime': 2 * 86400000, 'WallDuration': 3}])
+
+        # Each day's entry holds only the records of that day
+        replayer = SummaryReplayer(msg, None, config)
+        for _ in range(2):
+            records = list(replayer._summaryRecords())
+            self.assertEqual([(r['EndTime'], r['WallDuration']) for r in records],
+                             [('1970-01-02T00:00:00.000Z', 2), ('1970-01-03T00:00:00.000Z', 3)])
+        self.assertEqual(len(replayer.cache.load('summary', datetime.date(1970, 1, 2),
+                                                 replayer._dayMarker(getClient.return_value,
+                                                                     datetime.date(1970, 1, 2)))), 1)
+
+    @mock.patch.object(summary_replayer, 'getClient')
+    @mock.patch.object(summary_replayer, 'getReferenceData')
+    def test_across_midnight(self, getReferenceData, getClient):
+        config = {'General': {'summary_cache_dir': self.directory},
+                  'ElasticSearch': {'transfer_index': 'transfer', 'summary_engine': 'composite'}}
+        msg = {'destination': 'data', 'routing_key': 'data-key', 'kind': 'transfer_summary',
+               'from': '1970-01-02', 'to': '1970-01-03'}
+        getClient.return_value = FakeCompositeClient(
+            [{'StartTime': 86400000, 'EndTime': 86400000 + 3600000, 'Network': 2},
+             {'StartTime': 86400000, 'EndTime': 2 * 86400000 + 3600000, 'Network': 3}])
+
+        # The transfers are summarized together, and nothing is cached
+        replayer = SummaryReplayer(msg, None, config)
+        records = list(replayer._summaryRecords())
+        self.assertEqual([(r['StartTime'], r['Network']) for r in records], [('1970-01-02T00:00:00.000Z', 5)])
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
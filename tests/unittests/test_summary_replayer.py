@@ -0,0 +1,239 @@
+import collections
+import copy
+import datetime
+import time
+import unittest
+from unittest import mock
+
+from opensearchpy import Search, A
+
+from graccreq import summary_replayer
+from graccreq.summary_replayer import SummaryReplayer, DefaultMerger, flattenBuckets, prefetchPages, Page
+
+
+TERMS = [['EndTime', 0], ['VOName', 'N/A'], ['ProbeName', 'N/A']]
+METRICS = [['WallDuration', 0], ['Njobs', 1]]
+
+
+class FakeCompositeClient(object):
+    """
+    Answers composite aggregations over a list of documents, with missing
+    values ordered first
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.searches = 0
+
+    def search(self, index=None, body=None, filter_path=None):
+        assert filter_path == summary_replayer.aggregation_filter_path
+        self.searches += 1
+        comp = body['aggs']['comp']
+        names = [list(source)[0] for source in comp['composite']['sources']]
+        groups = collections.OrderedDict()
+        for doc in self.docs:
+            if not self._inRange(doc, body):
+                continue
+            key = tuple(doc.get(name) for name in names)
+            group = groups.setdefault(key, {'doc_count': 0})
+            group['doc_count'] += 1
+            for metric, agg in comp['aggs'].items():
+                group[metric] = group.get(metric, 0) + doc.get(metric, agg['sum']['missing'])
+
+        order = lambda key: [(value is not None, value) for value in key]
+        keys = sorted(groups, key=order)
+        if 'after' in comp['composite']:
+            after = tuple(comp['composite']['after'][name] for name in names)
+            keys = [key for key in keys if order(key) > order(after)]
+        buckets = []
+        for key in keys[:comp['composite']['size']]:
+            bucket = {'key': dict(zip(names, key)), 'doc_count': groups[key]['doc_count']}
+            bucket.update({metric: {'value': value} for metric, value in groups[key].items() if metric != 'doc_count'})
+            buckets.append(bucket)
+        aggregation = {'buckets': buckets}
+        if buckets:
+            aggregation['after_key'] = buckets[-1]['key']
+        return {'took': 1, 'timed_out': False, 'hits': {'hits': []}, 'aggregations': {'comp': aggregation}}
+
+    @staticmethod
+    def _inRange(doc, body):
+        """
+        Whether a document matches the range filters of the query, with
+        dates in milliseconds since the epoch
+        """
+        millis = lambda day: (day - datetime.date(1970, 1, 1)).days * 86400000
+        for query in body.get('query', {}).get('bool', {}).get('filter', []):
+            for field, bounds in query.get('range', {}).items():
+                if doc.get(field) is None or not millis(bounds['gte']) <= doc[field] < millis(bounds['lt']):
+                    return False
+        return True
+
+
+def nestedBucket(terms, depth=0, seed=1):
+    """
+    Nested terms buckets with a varying number of sub-buckets, some empty
+    """
+    if depth == len(terms):
+        return {'Wall': {'value': seed * 1.5}, 'doc_count': seed}
+    buckets = []
+    for i in range(seed % 3 if depth else 3):
+        bucket = {'key': '%s-%i' % (terms[depth], i)}
+        bucket.update(nestedBucket(terms, depth + 1, seed + i + depth))
+        buckets.append(bucket)
+    return {terms[depth]: {'buckets': buckets}}
+
+
+def recurseBucket(curData, curBucket, index, data, terms):
+    """
+    How buckets used to be flattened
+    """
+    curTerm = terms[index]
+    if not curBucket[curTerm]['buckets']:
+        data.append(copy.deepcopy(curData))
+    else:
+        for bucket in curBucket[curTerm]['buckets']:
+            nowData = copy.deepcopy(curData)
+            nowData[curTerm] = bucket['key']
+            if index == len(terms) - 1:
+                nowData['Wall'] = bucket['Wall']['value']
+                nowData['Count'] = bucket['doc_count']
+                data.append(nowData)
+            else:
+                recurseBucket(nowData, bucket, index + 1, data, terms)
+
+
+class TestPrefetchPages(unittest.TestCase):
+    def fetcher(self, pages, fail=None):
+        self.fetched = []
+
+        def fetch(after):
+            start = 0 if after is None else after + 1
+            self.fetched.append(start)
+            if start == fail:
+                raise ValueError("search failed")
+            if start >= pages:
+                return None
+            return Page([start], start, 0.0, 1)
+        return fetch
+
+    def test_pages(self):
+        for depth in (0, 1, 3):
+            pages = prefetchPages(self.fetcher(5), depth=depth)
+            self.assertEqual([page.buckets for page in pages], [[0], [1], [2], [3], [4]])
+        self.assertEqual(list(prefetchPages(self.fetcher(5), after=2)), [Page([3], 3, 0.0, 1), Page([4], 4, 0.0, 1)])
+
+    def test_ahead(self):
+        pages = prefetchPages(self.fetcher(10), depth=2)
+        next(pages)
+        for _ in range(100):
+            if len(self.fetched) >= 3:
+                break
+            time.sleep(0.01)
+        # The next pages are fetched while the first one is processed
+        self.assertGreaterEqual(len(self.fetched), 3)
+        pages.close()
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            list(prefetchPages(self.fetcher(5, fail=3)))
+
+
+class TestFlattenBuckets(unittest.TestCase):
+    def test_same_as_recursion(self):
+        terms = ['Processors', 'GPUs', 'DN', 'Grid']
+        bucket = nestedBucket(terms)
+        expected = []
+        for processor in bucket['Processors']['buckets']:
+            recurseBucket({'Processors': processor['key']}, processor, 1, expected, terms)
+        records = list(flattenBuckets(bucket, terms, ['Wall']))
+        self.assertTrue(any('Count' not in r for r in records))
+        self.assertEqual(records, expected)
+        self.assertEqual([list(r) for r in records], [list(r) for r in expected])
+
+
+class TestDefaultMerger(unittest.TestCase):
+    def record(self, values, wall):
+        record = {name: value if value is not None else default for (name, default), value in zip(TERMS, values)}
+        record.update({'WallDuration': wall, 'Njobs': 1, 'Count': 1})
+        return record
+
+    def test_merge(self):
+        merger = DefaultMerger(TERMS, METRICS)
+        rows = [(0, None, 'a'), (0, None, 'b'), (0, 'N/A', 'a'), (0, 'cms', None), (0, 'cms', 'N/A'), (0, 'cms', 'x')]
+        done = []
+        for i, values in enumerate(rows):
+            done.extend(merger.add(values, self.record(values, i)))
+        done.extend(merger.finish())
+        by_key = {(r['VOName'], r['ProbeName']): r for r in done}
+        self.assertEqual(len(done), 4)
+        self.assertEqual(by_key[('N/A', 'a')]['WallDuration'], 0 + 2)
+        self.assertEqual(by_key[('N/A', 'a')]['Count'], 2)
+        self.assertEqual(by_key[('cms', 'N/A')]['WallDuration'], 3 + 4)
+
+    def test_release(self):
+        # Rows are released once no later row can be merged into them
+        merger = DefaultMerger(TERMS, METRICS)
+        merger.add((0, 'atlas', 'x'), self.record((0, 'atlas', 'x'), 0), {'VOName': 'atlas'})
+        self.assertEqual(merger.add((0, 'cms', None), self.record((0, 'cms', None), 1), {'VOName': 'cms'}), [])
+        # Resuming would read the held back row again
+        self.assertEqual(merger.resumeAfter({'VOName': 'cms'}), {'VOName': 'atlas'})
+        self.assertEqual(len(merger.add((0, 'dune', 'x'), self.record((0, 'dune', 'x'), 2), {'VOName': 'dune'})), 2)
+        self.assertEqual(merger.resumeAfter({'VOName': 'dune'}), {'VOName': 'dune'})
+
+
+class TestCompositeEngine(unittest.TestCase):
+    @mock.patch.object(summary_replayer, 'getReferenceData')
+    def test_scan(self, getReferenceData):
+        docs = []
+        for i in range(40):
+            doc = {'EndTime': 86400000 * (1 + i // 20), 'WallDuration': i}
+            if i % 3:
+                doc['VOName'] = ['cms', 'N/A', 'atlas'][i % 4 % 3]
+            if i % 5:
+                doc['ProbeName'] = 'probe%i' % (i % 2)
+            docs.append(doc)
+        client = FakeCompositeClient(docs)
+
+        config = {'ElasticSearch': {'summary_page_size': 2, 'summary_page_min': 2, 'summary_page_max': 2}}
+        replayer = SummaryReplayer({'destination': 'data', 'routing_key': 'data-key'}, None, config)
+        positions = []
+        replayer.pageDone = positions.append
+        records = list(replayer._scanComposite(client, 'raw', Search(using=client, index='raw'),
+                                               A('date_histogram', field='EndTime', calendar_interval='1d'),
+                                               TERMS, METRICS))
+
+        expected = collections.Counter()
+        for doc in docs:
+            key = tuple(doc.get(name, default) for name, default in TERMS)
+            expected[key] += doc['WallDuration']
+        self.assertEqual({tuple(r[name] for name, _ in TERMS): r['WallDuration'] for r in records}, dict(expected))
+        self.assertEqual(sum(r['Count'] for r in records), 40)
+        self.assertEqual(sum(r['Njobs'] for r in records), 40)
+        self.assertTrue(positions)
+
+        # Resuming from any checkpoint gives every record at least once, and
+        # the same sums for each of them
+        for position in positions:
+            resumed = list(replayer._scanComposite(client, 'raw', Search(using=client, index='raw'),
+                                                   A('date_histogram', field='EndTime', calendar_interval='1d'),
+                                                   TERMS, METRICS, position))
+            for record in resumed:
+                key = tuple(record[name] for name, _ in TERMS)
+                self.assertEqual(record['WallDuration'], expected[key])
+        self.assertGreater(client.searches, len(records) // 2)
+
+    def test_partition_range(self):
+        # A record at the next midnight belongs to the next day's partition
+        docs = [{'EndTime': 86400000, 'VOName': 'cms', 'WallDuration': 2},
+                {'EndTime': 86400000, 'VOName': 'cms', 'WallDuration': 3},
+                {'EndTime': 2 * 86400000, 'VOName': 'cms', 'WallDuration': 7}]
+        config = {'ElasticSearch': {'raw_index': 'raw', 'summary_engine': 'composite'}}
+        with mock.patch.object(summary_replayer, 'getReferenceData'), \
+                mock.patch.object(summary_replayer, 'getClient', return_value=FakeCompositeClient(docs)):
+            replayer = SummaryReplayer({'destination': 'data', 'routing_key': 'data-key'}, None, config)
+            records = list(replayer._queryElasticsearch('1970-01-02', '1970-01-02', None))
+        self.assertEqual([(r['EndTime'], r['WallDuration']) for r in records],
+                         [('1970-01-02T00:00:00.000Z', 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()